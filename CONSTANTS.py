@@ -4,4 +4,50 @@ MARKER = "."
 DATA_FOLDER_NAME = "local\DATA_NFFA-DI"
 DEBUG_MODE = True
 MARKER_SIZE = 4
-SETTLING_TIME = 0.25
\ No newline at end of file
+SETTLING_TIME = 0.25
+VNA_DATA_FORMAT = "REAL,32"
+STORAGE_FORMAT = "csv"
+PIPELINE_QUEUE_SIZE = 4
+SIMULATE = False
+SIM_FIELD_PER_AMP = 50.0
+SIM_VNA_COMMAND_LATENCY = 0.002
+SIM_VNA_TRANSFER_RATE = 1e6
+SIM_PS_LATENCY = 0.01
+PS_TIMEOUT = 2.0
+PS_READBACK_COMMAND = "CUR?"
+SETTLING_MODE = "fixed"
+SETTLING_TOLERANCE = 0.002
+SETTLING_TIMEOUT = 2.0
+SETTLING_POLL_INTERVAL = 0.02
+RAMP_RATE = 1.0
+PS_RAMP_RATE_RANGE = (0.01, 2.0)
+FIELD_ORDER = "as_given"
+VNA_TRANSFER_RATE = 1e6
+SWEEP_MODE = "software"
+PS_LIST_COMMAND = "LIST"
+DEMAG_START_CURRENT = 3.0
+DEMAG_DECAY = 0.5
+DEMAG_STEPS = 13
+DEMAG_SHAPE = "table"
+DEMAG_TABLE = [3, -1.5, 0.75, -0.375, 0.1875, -0.09375, 0.045, -0.02, 0.01, -0.005, 0.002, -0.001, 0.0005]
+DEMAG_STEP_TIME = 0.5
+PS_PORTS = [("COM3", 9600), ("COM4", 9600)]
+PS_MAX_CURRENT = 3.6
+ANGLE_ORDER = "as_given"
+AVG_VARIANCE_TARGET = None
+FREQUENCY_MODE = "uniform"
+ADAPTIVE_SURVEY_POINTS = 201
+ADAPTIVE_POINT_FRACTION = 0.25
+ADAPTIVE_SPARSE_FRACTION = 0.2
+ADAPTIVE_THRESHOLD = 5.0
+ADAPTIVE_MARGIN = 1.0
+TRACKING_WINDOW = 1e9
+TRACKING_CHECK_EVERY = 10
+TRACKING_HISTORY = 5
+REFERENCE_MODE = "divide"
+FIT_MODEL = "complex"
+FIT_MAX_ITERATIONS = 100
+FIT_TOLERANCE = 1e-10
+FIT_GUESS_WINDOW = 500e6
+FIT_CHUNK_SIZE = 256
+FIT_WORKERS = None
\ No newline at end of file
@@ -6,11 +6,24 @@ from library_power_supply import *
 from CONSTANTS import *
 from measurement_routine import measurement_routine
 from library_file_management import *
+from library_startup import setupInstruments
 import numpy as np
 
 
 logger.info("*** LOG SCREEN ***")
 
+ps1 = ps2 = instr = None
+demag_task = None
+
+def startDemag(supplies: list[PowerSupply]) -> DemagTask | None:
+    # The demagnetizing sweep runs in the background while the VNA is reset and configured,
+    # setupInstruments stops it if the VNA setup fails
+    global demag_task
+    if settings.get("demag", False):
+        supplies = [ps for ps in (supplies[:1] if settings["dipole_mode"] == 1 else supplies) if ps]
+        demag_task = DemagTask(supplies, demagCurrents(shape=settings.get("demag_profile", DEMAG_SHAPE)))
+    return demag_task
+
 try:
     settings = gui_measurement_startup()
     if settings is None:
@@ -20,15 +33,15 @@ try:
     settings["datetime"] = str(datetime.now()).rstrip("0123456789").rstrip(".")
 
     logger.info("Setting up power supplies and VNA...")
-    ps1 = setupConnectionPS('COM3', 9600)
-    ps2 = setupConnectionPS('COM4', 9600)
-    instr = setupConnectionVNA()
+    simulate = settings.get("simulate", SIMULATE)
+    ps1, ps2, instr = setupInstruments(settings, PS_PORTS, simulate=simulate, on_supplies_ready=startDemag)
 
     settings["field_sweep"] = list(np.concatenate([[float(settings["ref_field"])], settings["field_sweep"]]))
-
-    applySettings(instr, settings)
     save_settings(settings)
 
+    if demag_task:
+        demag_task.wait()
+
     measurement_routine(
         settings,
         ps1, 
@@ -45,19 +58,18 @@ try:
         demag=False
     )
 
-    # Save metadata:
-    old_name = settings["measurement_name"]
-    for sparam in ["S11", "S21", "S12", "S22"]:
-        settings["measurement_name"] = f"{old_name}_{sparam}"
-        settings["s_parameter"] = sparam
-        save_metadata(settings)
-
     logger.info("Measurement routine completed successfully.")
 
 except Exception as e:
     logger.error(f"An error occurred: {e}")
 
 finally:
+    if demag_task:
+        demag_task.cancel()
+        try:
+            demag_task.wait()
+        except Exception as e:
+            logger.error(f"An error occurred during the demagnetizing sweep: {e}")
     if ps1:
         ps1.closeConnection()
     if ps2:
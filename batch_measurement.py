@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+from datetime import datetime
+from time import perf_counter
+import logging
+
+import numpy as np
+
+import CONSTANTS as c
+from library_file_management import REFERENCE_MODES, writer_output_paths, write_json_atomic
+from library_power_supply import DemagTask, demagCurrents, fieldToCurrents
+from library_startup import setupInstruments
+from library_vna import SPARAMETERS, VNASession
+from measurement_routine import measurement_routine
+
+"""
+Runs a queue of measurements without the GUI, keeping the instruments connected from one job to the next.
+Every job is a settings file in the format of last_settings.json (field_sweep starts with the reference field).
+All jobs are validated before the first one starts. The VNA is only reconfigured where the settings of a job differ from the previous one.
+The status of the jobs is kept in a JSON file that is updated at every change, and each job writes its own status.json in the folders its data is written to.
+
+Example:
+    python batch_measurement.py jobs/angle_0.json jobs/angle_45.json jobs/angle_90.json
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REQUIRED_KEYS = [
+    "user_name", "sample_name", "measurement_name", "dipole_mode", "s_parameter", "field_sweep", "angle",
+    "start_frequency", "stop_frequency", "number_of_points", "bandwidth", "power", "ref_field", "cal_name", "avg_factor",
+]
+
+# Allowed values of the optional settings
+CHOICES = {
+    "sweep_mode": ["software", "triggered"],
+    "settling_mode": ["fixed", "adaptive"],
+    "field_order": ["as_given", "ascending", "descending", "nearest"],
+    "angle_order": ["as_given", "serpentine", "nearest"],
+    "frequency_mode": ["uniform", "adaptive", "tracking"],
+    "storage_format": ["hdf5", "csv"],
+    "reference_mode": REFERENCE_MODES,
+    "demag_profile": ["table", "geometric", "linear"],
+}
+
+
+def validate_settings(settings: dict) -> list[str]:
+    """
+    Returns the problems found in the settings of one job, an empty list if it can be run.
+    """
+    missing = [key for key in REQUIRED_KEYS if key not in settings]
+    if missing:
+        return [f"missing settings: {', '.join(missing)}"]
+
+    problems = []
+    if settings["dipole_mode"] not in (1, 2):
+        problems.append(f"dipole_mode must be 1 or 2, not {settings['dipole_mode']}")
+    if not settings["field_sweep"]:
+        problems.append("field_sweep is empty")
+    if not settings["start_frequency"] < settings["stop_frequency"]:
+        problems.append("start_frequency must be lower than stop_frequency")
+    if int(settings["number_of_points"]) < 1:
+        problems.append("number_of_points must be positive")
+    if float(settings["bandwidth"]) <= 0:
+        problems.append("bandwidth must be positive")
+    if int(settings["avg_factor"]) < 1:
+        problems.append("avg_factor must be at least 1")
+    min_rate, max_rate = c.PS_RAMP_RATE_RANGE
+    if "ramp_rate" in settings and not min_rate <= float(settings["ramp_rate"]) <= max_rate:
+        problems.append(f"ramp_rate must be between {min_rate} and {max_rate} A/s, not {settings['ramp_rate']}")
+    for key, values in CHOICES.items():
+        if key in settings and settings[key] not in values:
+            problems.append(f"{key} must be one of {values}, not {settings[key]}")
+    if settings.get("sweep_mode") == "triggered" and int(settings["avg_factor"]) != 1:
+        problems.append("triggered sweep mode needs avg_factor 1")
+    if settings.get("sweep_mode") == "triggered" and settings.get("frequency_mode") == "adaptive":
+        problems.append("the adaptive frequency mode cannot be used in triggered sweep mode")
+
+    if np.ndim(settings["angle"]) > 0 and settings["dipole_mode"] != 2:
+        problems.append("a sweep over several angles needs dipole_mode 2")
+    if settings["dipole_mode"] in (1, 2) and settings["field_sweep"]:
+        currents = np.array([fieldToCurrents(field, angle, settings["dipole_mode"]) for angle in np.atleast_1d(settings["angle"]) for field in settings["field_sweep"]])
+        if np.max(np.abs(currents)) > c.PS_MAX_CURRENT:
+            problems.append(f"field_sweep needs {np.max(np.abs(currents)):.2f}A, more than the max current of {c.PS_MAX_CURRENT}A")
+
+    for path in writer_output_paths(settings, SPARAMETERS):
+        if os.path.exists(path):
+            problems.append(f"measurement folder {path} already exists")
+    return problems
+
+
+def load_jobs(settings_files: list[str]) -> list[dict]:
+    """
+    Reads and validates all the settings files, raises ValueError listing every problem if any job cannot be run.
+    """
+    jobs = []
+    problems = []
+    for settings_file in settings_files:
+        try:
+            with open(settings_file) as f:
+                settings = json.load(f)
+        except (OSError, ValueError) as e:
+            problems.append(f"{settings_file}: {e}")
+            continue
+        try:
+            problems += [f"{settings_file}: {problem}" for problem in validate_settings(settings)]
+        except (TypeError, ValueError) as e:
+            problems.append(f"{settings_file}: invalid value, {e}")
+        jobs.append({"settings_file": settings_file, "settings": settings})
+
+    paths = [path for job in jobs if all(key in job["settings"] for key in REQUIRED_KEYS) for path in writer_output_paths(job["settings"], SPARAMETERS)]
+    problems += [f"measurement folder {path} is used by more than one job" for path in sorted(set(paths)) if paths.count(path) > 1]
+
+    if problems:
+        raise ValueError("Invalid batch:\n" + "\n".join(problems))
+    return jobs
+
+
+def run_job(settings: dict, ps1, ps2, session: VNASession) -> None:
+    """
+    Brings the VNA to the settings of the job, running the demagnetizing sweep at the same time if the job asks for it, and measures.
+    """
+    settings["datetime"] = str(datetime.now()).rstrip("0123456789").rstrip(".")
+
+    demag_task = None
+    if settings.get("demag", False):
+        supplies = [ps for ps in ([ps1] if settings["dipole_mode"] == 1 else [ps1, ps2]) if ps]
+        demag_task = DemagTask(supplies, demagCurrents(shape=settings.get("demag_profile", c.DEMAG_SHAPE)))
+
+    try:
+        instr = session.configure(settings)
+    finally:
+        if demag_task:
+            demag_task.wait()
+
+    measurement_routine(
+        settings, ps1, ps2, instr, settings["field_sweep"], settings["angle"],
+        settings["user_name"], settings["sample_name"], settings["measurement_name"],
+        settings["dipole_mode"], settings["s_parameter"], settings["avg_factor"],
+    )
+
+
+def run_batch(jobs: list[dict], status_path: str, simulate: bool = False, stop_on_error: bool = False) -> list[dict]:
+    """
+    Runs the jobs in order and returns their status. A failed job is recorded and the next one is started, unless stop_on_error is set.
+    """
+    status = [
+        {"settings_file": job["settings_file"], "measurement_paths": writer_output_paths(job["settings"], SPARAMETERS), "status": "pending"}
+        for job in jobs
+    ]
+    write_json_atomic(status_path, status)
+
+    session = VNASession(simulate)
+    ps1 = ps2 = None
+    try:
+        ps1, ps2, _ = setupInstruments(jobs[0]["settings"], c.PS_PORTS, simulate=simulate, session=session)
+
+        for k, (job, job_status) in enumerate(zip(jobs, status)):
+            logger.info(f"Starting job {k+1}/{len(jobs)}: {job['settings_file']}")
+            job_status.update(status="running", start=str(datetime.now()))
+            write_json_atomic(status_path, status)
+            start = perf_counter()
+
+            try:
+                run_job(job["settings"], ps1, ps2, session)
+                job_status["status"] = "done"
+            except Exception as e:
+                logger.error(f"Job {job['settings_file']} failed: {e}")
+                job_status.update(status="failed", error=str(e))
+
+            job_status.update(end=str(datetime.now()), duration=perf_counter() - start)
+            write_json_atomic(status_path, status)
+            for path in job_status["measurement_paths"]:
+                if os.path.isdir(path):
+                    write_json_atomic(os.path.join(path, "status.json"), job_status)
+
+            if job_status["status"] == "failed" and stop_on_error:
+                for skipped in status[k+1:]:
+                    skipped["status"] = "skipped"
+                write_json_atomic(status_path, status)
+                break
+
+    finally:
+        for ps in (ps1, ps2):
+            if ps:
+                ps.closeConnection()
+        session.close()
+
+    done = sum(job_status["status"] == "done" for job_status in status)
+    logger.info(f"Batch finished: {done}/{len(status)} jobs done, status saved to {status_path}")
+    return status
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a queue of measurements from settings files.")
+    parser.add_argument("settings_files", nargs="+", help="settings files in the format of last_settings.json, run in the given order")
+    parser.add_argument("--status", help="JSON file the status of the jobs is written to, by default batch_<date>.json in DATA_FOLDER_NAME")
+    parser.add_argument("--simulate", action="store_true", default=c.SIMULATE, help="use the simulated instruments")
+    parser.add_argument("--stop-on-error", action="store_true", help="skip the remaining jobs after a failed one")
+    parser.add_argument("--check", action="store_true", help="only validate the settings files")
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.settings_files)
+    logger.info(f"{len(jobs)} jobs validated.")
+    if args.check:
+        return
+
+    status_path = args.status or os.path.join(c.DATA_FOLDER_NAME, f"batch_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(status_path) or ".", exist_ok=True)
+    run_batch(jobs, status_path, args.simulate, args.stop_on_error)
+
+
+if __name__ == "__main__":
+    main()
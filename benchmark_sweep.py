@@ -0,0 +1,132 @@
+import argparse
+import itertools
+import json
+import tempfile
+import tracemalloc
+from time import perf_counter
+import logging
+
+import numpy as np
+
+import CONSTANTS as c
+from library_misc import stage_timer
+from library_file_management import REFERENCE_MODES
+from library_vna import applySettings, resetVNA
+from library_simulation import SimulatedMagnet, SimulatedSerial, SimulatedVNA
+from library_power_supply import PowerSupply
+from measurement_routine import measurement_routine
+
+"""
+Runs measurement_routine against the simulated instruments for a matrix of point counts, field counts and averaging factors.
+For every combination the time spent in each stage of the sweep and the peak memory allocated by Python and numpy are reported.
+
+Example:
+    python benchmark_sweep.py --points 201 2001 20001 --fields 10 100 --avg 1 4 --output bench_output.json
+"""
+
+STAGES = ["ramp", "settle", "trigger", "transfer", "decode", "persist"]
+
+
+def run_benchmark(n_points: int, n_fields: int, avg: int, args: argparse.Namespace) -> dict:
+    """
+    Runs one simulated sweep and returns the stage timings in seconds and the peak memory in MB.
+    """
+    magnet = SimulatedMagnet()
+    ps1 = PowerSupply("COM3", 9600, SimulatedSerial("COM3", 9600, magnet, latency=args.ps_latency))
+    ps2 = PowerSupply("COM4", 9600, SimulatedSerial("COM4", 9600, magnet, latency=args.ps_latency))
+    instr = SimulatedVNA(magnet, command_latency=args.vna_latency, transfer_rate=args.transfer_rate)
+
+    settings = {
+        "user_name": "benchmark",
+        "sample_name": "simulated",
+        "measurement_name": f"points{n_points}_fields{n_fields}_avg{avg}",
+        "description": "",
+        "dipole_mode": 1,
+        "s_parameter": "S21",
+        "field_sweep": list(np.linspace(0, 150, n_fields)),
+        "angle": 0,
+        "start_frequency": 1e9,
+        "stop_frequency": 10e9,
+        "number_of_points": n_points,
+        "bandwidth": args.bandwidth,
+        "power": 0,
+        "ref_field": 0,
+        "cal_name": "",
+        "avg_factor": avg,
+        "storage_format": args.storage_format,
+        "settling_mode": args.settling_mode,
+        "field_order": args.field_order,
+        "sweep_mode": args.sweep_mode,
+        "avg_variance_target": args.variance_target,
+        "frequency_mode": args.frequency_mode,
+        "reference_mode": args.reference_mode,
+    }
+    resetVNA(instr)
+    applySettings(instr, settings)
+
+    stage_timer.reset()
+    tracemalloc.start()
+    start = perf_counter()
+    measurement_routine(
+        settings, ps1, ps2, instr, settings["field_sweep"], settings["angle"],
+        settings["user_name"], settings["sample_name"], settings["measurement_name"],
+        settings["dipole_mode"], settings["s_parameter"], avg,
+    )
+    total = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = stage_timer.report()
+    result = {"points": n_points, "fields": n_fields, "avg": avg}
+    result.update({stage: timings.get(stage, 0.0) for stage in STAGES})
+    result["total"] = total
+    result["peak_MB"] = peak / 1e6
+    result["ps_latency_ms"] = ps1.getLatencyReport()
+    return result
+
+
+def print_results(results: list[dict]) -> None:
+    columns = ["points", "fields", "avg"] + STAGES + ["total", "peak_MB"]
+    print("".join(f"{column:>10}" for column in columns))
+    for result in results:
+        print("".join(f"{result[column]:>10}" if isinstance(result[column], int) else f"{result[column]:>10.3f}" for column in columns))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark a full sweep against the simulated instruments.")
+    parser.add_argument("--points", type=int, nargs="+", default=[201, 2001, 20001], help="number of frequency points")
+    parser.add_argument("--fields", type=int, nargs="+", default=[10, 100], help="number of field steps")
+    parser.add_argument("--avg", type=int, nargs="+", default=[1], help="averaging factors")
+    parser.add_argument("--bandwidth", type=float, default=1e6, help="IF bandwidth in Hz, sets the simulated sweep time")
+    parser.add_argument("--settling-time", type=float, default=0.0, help="settling time after each field step in s")
+    parser.add_argument("--settling-mode", choices=["fixed", "adaptive"], default=c.SETTLING_MODE)
+    parser.add_argument("--field-order", choices=["as_given", "ascending", "descending", "nearest"], default=c.FIELD_ORDER)
+    parser.add_argument("--sweep-mode", choices=["software", "triggered"], default=c.SWEEP_MODE, help="step the field from the host or with the VNA trigger output")
+    parser.add_argument("--frequency-mode", choices=["uniform", "adaptive", "tracking"], default=c.FREQUENCY_MODE, help="measure every step on the full grid, densely around the resonances or in a window that follows the resonance")
+    parser.add_argument("--variance-target", type=float, default=c.AVG_VARIANCE_TARGET, help="stop averaging once the relative variance of the average is below this")
+    parser.add_argument("--vna-latency", type=float, default=c.SIM_VNA_COMMAND_LATENCY, help="simulated VNA command latency in s")
+    parser.add_argument("--transfer-rate", type=float, default=c.SIM_VNA_TRANSFER_RATE, help="simulated VNA transfer rate in bytes/s")
+    parser.add_argument("--ps-latency", type=float, default=c.SIM_PS_LATENCY, help="simulated power supply latency in s")
+    parser.add_argument("--storage-format", choices=["hdf5", "csv"], default=c.STORAGE_FORMAT)
+    parser.add_argument("--reference-mode", choices=REFERENCE_MODES, default=c.REFERENCE_MODE, help="also store the traces divided by or minus the reference field trace")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    c.SETTLING_TIME = args.settling_time
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_folder:
+        c.DATA_FOLDER_NAME = data_folder
+        for n_points, n_fields, avg in itertools.product(args.points, args.fields, args.avg):
+            results.append(run_benchmark(n_points, n_fields, avg, args))
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
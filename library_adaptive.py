@@ -0,0 +1,276 @@
+import numpy as np
+import logging
+
+from library_vna import RsInstrument, acquire_traces, decode_sparams, getVNAState, setLinearSweep, setSegments
+from library_misc import interpolate_complex
+import CONSTANTS as c
+
+"""
+This library adapts the frequency points of a sweep to the resonances while the sweep is running.
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def deviation_score(S: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """
+    Returns for every frequency point how many robust standard deviations |S / reference - 1| lies above its median,
+    taking the largest value over the S parameters. S and reference have shape (n_sparams, n_points).
+    """
+    deviation = np.abs(S / np.where(reference == 0, 1, reference) - 1)
+    median = np.median(deviation, axis=1, keepdims=True)
+    sigma = 1.4826 * np.median(np.abs(deviation - median), axis=1, keepdims=True)
+    return np.max((deviation - median) / np.maximum(sigma, np.finfo(float).tiny), axis=0)
+
+def absorption_score(S: np.ndarray, reference: np.ndarray, baseline: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+    """
+    Like deviation_score, but only counts the points where the magnitude of S drops below the reference, so the line of the
+    reference field itself (where |S / reference| rises) is not taken for the resonance.
+    baseline is the (median, sigma) of the absorption of every S parameter, as returned by absorption_baseline. By default it is
+    estimated from S itself, which needs most of the points to be off the line.
+    """
+    absorption = 1 - np.abs(S / np.where(reference == 0, 1, reference))
+    median, sigma = absorption_baseline(S, reference) if baseline is None else baseline
+    return np.max((absorption - median) / np.maximum(sigma, np.finfo(float).tiny), axis=0)
+
+def absorption_baseline(S: np.ndarray, reference: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the median and the robust standard deviation of the absorption 1 - |S / reference| of every S parameter, of shape (n_sparams, 1).
+    """
+    absorption = 1 - np.abs(S / np.where(reference == 0, 1, reference))
+    median = np.median(absorption, axis=1, keepdims=True)
+    return median, 1.4826 * np.median(np.abs(absorption - median), axis=1, keepdims=True)
+
+def find_resonances(freqs: np.ndarray, S: np.ndarray, reference: np.ndarray, threshold: float = c.ADAPTIVE_THRESHOLD, margin: float = c.ADAPTIVE_MARGIN) -> list[tuple[float, float]]:
+    """
+    Finds the frequency ranges where the traces S deviate from the reference traces (both of shape (n_sparams, n_points)).
+    A point belongs to a line if its deviation_score is above threshold.
+    Every line is widened by margin times its width on both sides, overlapping ranges are merged.
+    Returns a sorted list of (start frequency, stop frequency).
+    """
+    mask = deviation_score(S, reference) > threshold
+
+    if not np.any(mask):
+        return []
+
+    spacing = (freqs[-1] - freqs[0]) / max(len(freqs) - 1, 1)
+    edges = np.diff(np.concatenate([[0], mask.astype(int), [0]]))
+    regions = []
+    for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1):
+        width = max(freqs[last] - freqs[first], spacing)
+        start = max(freqs[0], freqs[first] - margin * width - spacing)
+        stop = min(freqs[-1], freqs[last] + margin * width + spacing)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(stop, regions[-1][1]))
+        else:
+            regions.append((start, stop))
+    return regions
+
+def _split(total: int, weights: np.ndarray, minimum: int) -> np.ndarray:
+    """
+    Splits total points proportionally to weights with at least minimum per entry, the result sums exactly to total.
+    """
+    counts = np.full(len(weights), minimum)
+    rest = total - counts.sum()
+    if rest <= 0 or not np.any(weights > 0):
+        return counts
+    shares = rest * weights / weights.sum()
+    counts += np.floor(shares).astype(int)
+    remainder = total - counts.sum()
+    counts[np.argsort(np.floor(shares) - shares)[:remainder]] += 1      # largest remainders first
+    return counts
+
+def plan_segments(start: float, stop: float, regions: list[tuple[float, float]], n_points: int, resolution: float, sparse_fraction: float = c.ADAPTIVE_SPARSE_FRACTION) -> list[tuple[float, float, int]]:
+    """
+    Plans a segmented sweep of exactly n_points between start and stop: the regions get points at the given resolution (spacing in Hz),
+    or as close to it as the budget of (1 - sparse_fraction) * n_points allows, and the rest of the span is covered sparsely.
+    Every region needs at least 2 points, if n_points is too small for all of them only the widest n_points // 2 regions are kept.
+    Returns a list of (start frequency, stop frequency, number of points) without repeated frequencies.
+    """
+    if n_points < 2:
+        raise ValueError(f"A segmented sweep needs at least 2 points, not {n_points}")
+    regions = np.array(regions, dtype=float).reshape(-1, 2)
+    if len(regions) == 0:
+        return [(start, stop, n_points)]
+    if len(regions) > n_points // 2:
+        widest = np.sort(np.argsort(regions[:, 0] - regions[:, 1], kind="stable")[:n_points // 2])
+        logger.info(f"{n_points} points are too few for {len(regions)} resonances, keeping the {len(widest)} widest.")
+        regions = regions[widest]
+    widths = regions[:, 1] - regions[:, 0]
+    needed = np.ceil(widths / resolution).astype(int) + 1
+    dense_budget = int(n_points * (1 - sparse_fraction))
+    dense = needed if needed.sum() <= dense_budget else _split(dense_budget, widths, 2)
+
+    gap_edges = np.concatenate([[start], regions.ravel(), [stop]]).reshape(-1, 2)
+    gap_widths = np.maximum(gap_edges[:, 1] - gap_edges[:, 0], 0)
+    sparse = _split(n_points - dense.sum(), gap_widths, 0)
+    sparse[gap_widths == 0] = 0
+    dense[-1] += n_points - dense.sum() - sparse.sum()      # points a gap of zero width could not take
+
+    segments = []
+    for k, ((gap_start, gap_stop), points) in enumerate(zip(gap_edges, sparse)):
+        if points > 0:
+            # the gap points stay strictly outside the neighbouring regions, so no frequency is measured twice
+            include_start, include_stop = k == 0, k == len(gap_edges) - 1
+            step = (gap_stop - gap_start) / max(points + 1 - include_start - include_stop, 1)
+            first = gap_start if include_start else gap_start + step
+            last = gap_stop if include_stop else gap_stop - step
+            segments.append((first, last, int(points)))
+        if k < len(regions):
+            segments.append((regions[k, 0], regions[k, 1], int(dense[k])))
+    return [segment for segment in segments if segment[2] > 0]
+
+
+class AdaptiveFrequencyPlan:
+    """
+    Chooses the frequency points of every field step of a sweep with frequency_mode "adaptive".
+    The reference field steps are measured on a uniform grid, reference_steps[i] is the reference step of step i (by default step 0
+    for every step, in a sweep over angles each angle has its own). Before every other step a coarse survey sweep is compared with
+    the reference of its angle to find the resonances, and the step is measured with a segmented sweep that has the resolution of the full
+    number_of_points grid around them and few points elsewhere. Every step has points_per_step points, so the data keeps a fixed shape.
+    """
+
+    def __init__(self, settings: dict, reference_steps: np.ndarray | None = None) -> None:
+        self.start = float(settings["start_frequency"])
+        self.stop = float(settings["stop_frequency"])
+        self.power = settings["power"]
+        self.bandwidth = settings["bandwidth"]
+        n_points = int(settings["number_of_points"])
+        self.resolution = (self.stop - self.start) / max(n_points - 1, 1)
+        self.points_per_step = int(settings.get("adaptive_points", max(2, round(n_points * c.ADAPTIVE_POINT_FRACTION))))
+        self.survey_points = int(settings.get("survey_points", c.ADAPTIVE_SURVEY_POINTS))
+        self.reference_steps = reference_steps
+        self.references = {}
+
+    def reference_step(self, i: int) -> int:
+        return 0 if self.reference_steps is None else int(self.reference_steps[i])
+
+    def observe(self, i: int, freqs: np.ndarray, S: np.ndarray) -> None:
+        """
+        Called with the traces of every measured step, of shape (n_sparams, n_points). The reference field steps are kept.
+        """
+        if self.reference_step(i) == i:
+            self.references[i] = (np.array(freqs), np.array(S))
+
+    def prepare_step(self, instr: RsInstrument, i: int) -> None:
+        """
+        Sets the frequency points of step i on the VNA, the other steps need their reference step passed to observe first.
+        """
+        r = self.reference_step(i)
+        if r == i or r not in self.references:
+            setLinearSweep(instr, self.points_per_step)
+            return
+
+        setLinearSweep(instr, self.survey_points)
+        freq, tracelist = acquire_traces(instr, 1)
+        S = decode_sparams(tracelist, len(freq))
+        reference = interpolate_complex(freq, *self.references[r])
+
+        regions = find_resonances(freq, S, reference)
+        if not regions:
+            logger.info("No resonance found in the survey, measuring on a uniform grid.")
+            setLinearSweep(instr, self.points_per_step)
+            return
+
+        segments = plan_segments(self.start, self.stop, regions, self.points_per_step, self.resolution)
+        logger.info(f"Resonances at {', '.join(f'{a / 1e9:.3f}-{b / 1e9:.3f} GHz' for a, b in regions)}, measuring {len(segments)} segments.")
+        setSegments(instr, segments, self.power, self.bandwidth)
+
+    def restore(self, instr: RsInstrument, settings: dict) -> None:
+        """
+        Goes back to the uniform sweep of the settings.
+        """
+        setLinearSweep(instr, int(settings["number_of_points"]))
+
+
+class ResonanceTracker:
+    """
+    Follows the resonance through a sweep with frequency_mode "tracking".
+    After every step the resonance is located as the strongest absorption against the reference step of its angle
+    (reference_steps, as for AdaptiveFrequencyPlan), and a polynomial in the field fitted to the last positions
+    measured at the same angle predicts where it will be at the next step. The next step is then measured only in a window of
+    tracking_window Hz around the prediction with window_points points, at the resolution of the full number_of_points grid.
+    The full span is measured with all number_of_points points for the reference, whenever there is no prediction yet or the
+    resonance was lost, and every tracking_check_every steps as a check.
+    points_per_step is number_of_points, the steps measured in a window are shorter and padded with NaN in the SweepData.
+    A window is mostly covered by the line, so the noise of the absorption is taken from the last full span step.
+    """
+
+    def __init__(self, settings: dict, fields: np.ndarray, angles: np.ndarray, reference_steps: np.ndarray | None = None) -> None:
+        self.start = float(settings["start_frequency"])
+        self.stop = float(settings["stop_frequency"])
+        self.fields = np.asarray(fields, dtype=float)
+        self.angles = np.asarray(angles, dtype=float)
+        n_points = int(settings["number_of_points"])
+        resolution = (self.stop - self.start) / max(n_points - 1, 1)
+        self.window = min(float(settings.get("tracking_window", c.TRACKING_WINDOW)), self.stop - self.start)
+        self.points_per_step = n_points
+        self.window_points = min(n_points, int(np.ceil(self.window / resolution)) + 1)
+        self.check_every = int(settings.get("tracking_check_every", c.TRACKING_CHECK_EVERY))
+        self.reference_steps = np.zeros(len(self.fields), dtype=int) if reference_steps is None else np.asarray(reference_steps)
+        self.references = {}
+        self.baseline = None
+        self.positions = np.full(len(self.fields), np.nan)
+        self.full_span = np.zeros(len(self.fields), dtype=bool)
+
+    def predict(self, i: int) -> float | None:
+        """
+        Predicts the resonance frequency at step i from the positions found at the previous steps with the same angle,
+        None if they were found at fewer than two fields.
+        """
+        same_angle = np.flatnonzero((self.angles[:i] == self.angles[i]) & ~np.isnan(self.positions[:i]))[-c.TRACKING_HISTORY:]
+        fields, positions = self.fields[same_angle], self.positions[same_angle]
+        degree = min(2, len(np.unique(fields)) - 1)
+        if degree < 1:
+            return None     # one position says nothing about how fast the resonance moves
+        return float(np.polyval(np.polyfit(fields, positions, degree), self.fields[i]))
+
+    def prepare_step(self, instr: RsInstrument, i: int) -> None:
+        """
+        Sets the frequency window of step i on the VNA.
+        """
+        state = getVNAState(instr)
+        r = self.reference_steps[i]
+        lost = i > 1 and not self.full_span[i - 1] and np.isnan(self.positions[i - 1])
+        prediction = None if r == i or r not in self.references or lost or i % self.check_every == 0 else self.predict(i)
+
+        if prediction is None or not self.start <= prediction <= self.stop:
+            start, stop, n_points = self.start, self.stop, self.points_per_step
+            self.full_span[i] = True
+        else:
+            start = min(max(prediction - self.window / 2, self.start), self.stop - self.window)
+            stop, n_points = start + self.window, self.window_points
+            logger.info(f"Resonance predicted at {prediction / 1e9:.3f} GHz, measuring {start / 1e9:.3f}-{stop / 1e9:.3f} GHz.")
+
+        setLinearSweep(instr, n_points)
+        state.write(instr, "SENS1:FREQ:STAR", start)
+        state.write(instr, "SENS1:FREQ:STOP", stop)
+
+    def observe(self, i: int, freqs: np.ndarray, S: np.ndarray) -> None:
+        """
+        Locates the resonance in the traces of step i, the reference field steps are kept.
+        """
+        r = self.reference_steps[i]
+        if r == i:
+            self.references[i] = (np.array(freqs), np.array(S))
+            return
+        if r not in self.references:
+            return
+
+        reference = interpolate_complex(freqs, *self.references[r])
+        if self.full_span[i] or self.baseline is None:
+            self.baseline = absorption_baseline(S, reference)
+        score = absorption_score(S, reference, self.baseline)
+        if np.max(score) > c.ADAPTIVE_THRESHOLD:
+            self.positions[i] = freqs[np.argmax(score)]
+        else:
+            logger.info("Resonance lost, the next step is measured over the full span.")
+
+    def restore(self, instr: RsInstrument, settings: dict) -> None:
+        """
+        Goes back to the frequency span and points of the settings.
+        """
+        state = getVNAState(instr)
+        state.write(instr, "SENS1:FREQ:STAR", settings["start_frequency"])
+        state.write(instr, "SENS1:FREQ:STOP", settings["stop_frequency"])
+        setLinearSweep(instr, int(settings["number_of_points"]))
@@ -2,30 +2,137 @@ import os
 import numpy as np
 import json
 import pandas as pd
+import h5py
 from matplotlib import pyplot as plt
 import logging
 
 from logger import logger
+from library_misc import interpolate_complex
 import CONSTANTS as c
 
 logging.basicConfig(level=logging.INFO)
 
+# Columns of the measurement CSV files
+CSV_COLUMNS = ["Frequency", "Field", "Current (dipole mode)", "Current1 (quadrupole mode)", "Current2 (quadrupole mode)", "Amplitude", "Phase", "S_param"]
+# Column added when the traces are also stored normalized to the reference field
+NORMALIZED_COLUMN = "Normalized S_param"
+
+# Ways of normalizing the traces to the reference field, "none" stores only the raw traces
+REFERENCE_MODES = ["divide", "subtract", "none"]
+
 def create_measurement_path(settings):
     return os.path.join(c.DATA_FOLDER_NAME, settings["user_name"], settings["sample_name"], settings["measurement_name"])
 
+class SweepData:
+    """
+    Preallocated container for the results of a field sweep.
+    The complex S parameters are stored in a (n_fields, n_sparams, n_points) array that is filled in place one field step at a time.
+    For a sweep over (angle, field) every step also has an angle, and grid_steps[a, f] gives the step of angle a and field f,
+    so grid returns the data indexed by angle.
+    With varying_freqs every step keeps its own frequency points in step_freqs, for sweeps whose frequency grid changes from step to step.
+    A step with fewer than n_points points is padded with NaN in step_freqs and S.
+    With reference_mode "divide" or "subtract" every step is also stored in dS normalized to the reference field measured at
+    the same angle, the first field of its row of grid_steps: S(H) / S(H_ref) or S(H) - S(H_ref).
+    The reference step of an angle has to be set before the other steps of that angle.
+    """
+
+    def __init__(self, field_sweep: list[float], n_points: int, sparams: list[str], dtype=np.complex64, angles: list[float] | None = None, grid_steps: np.ndarray | None = None, varying_freqs: bool = False, reference_mode: str = "none") -> None:
+        if reference_mode not in REFERENCE_MODES:
+            raise ValueError(f"Unknown reference mode: {reference_mode}")
+        self.fields = np.asarray(field_sweep, dtype=float)
+        self.angles = np.zeros(len(self.fields)) if angles is None else np.asarray(angles, dtype=float)
+        self.grid_steps = np.arange(len(self.fields)).reshape(1, -1) if grid_steps is None else np.asarray(grid_steps)
+        self.reference_steps = np.zeros(len(self.fields), dtype=int)
+        for row in self.grid_steps:
+            self.reference_steps[row] = row[0]
+        self.sparams = list(sparams)
+        self.freqs = np.zeros(n_points)
+        self.step_freqs = np.zeros((len(self.fields), n_points)) if varying_freqs else None
+        self.S = np.zeros((len(self.fields), len(self.sparams), n_points), dtype=dtype)
+        self.currents = np.zeros((len(self.fields), 3))  # dipole current, quadrupole current 1, quadrupole current 2
+        self.reference_mode = reference_mode
+        self.dS = None if reference_mode == "none" else np.zeros_like(self.S)
+        self.n_done = 0
+
+    def set_step(self, i: int, freq: np.ndarray, S: np.ndarray, currents: tuple[float, float, float]) -> None:
+        """
+        Stores the traces measured at field step i, S must have shape (n_sparams, n_points).
+        """
+        n = len(freq)
+        if i == 0:
+            self.freqs[:n] = freq
+        if self.step_freqs is not None:
+            self.step_freqs[i, :n] = freq
+            self.step_freqs[i, n:] = np.nan
+        self.S[i, :, :n] = S
+        self.S[i, :, n:] = np.nan
+        self.currents[i] = currents
+        if self.dS is not None:
+            self.dS[i] = self.normalize(i)
+        self.n_done = max(self.n_done, i + 1)
+
+    def freqs_at(self, i: int) -> np.ndarray:
+        return self.freqs if self.step_freqs is None else self.step_freqs[i]
+
+    def normalize(self, i: int) -> np.ndarray:
+        """
+        Returns the traces of step i normalized to the reference step of its angle, which is interpolated onto the frequency points
+        of step i if they differ.
+        """
+        r = self.reference_steps[i]
+        reference = self.S[r]
+        if self.step_freqs is not None and not np.array_equal(self.step_freqs[i], self.step_freqs[r], equal_nan=True):
+            # only the measured points are interpolated, the NaN padding of shorter steps stays NaN
+            measured, reference_measured = ~np.isnan(self.step_freqs[i]), ~np.isnan(self.step_freqs[r])
+            reference = np.full_like(self.S[i], np.nan)
+            reference[:, measured] = interpolate_complex(self.step_freqs[i, measured], self.step_freqs[r, reference_measured], self.S[r][:, reference_measured])
+        if self.reference_mode == "subtract":
+            return self.S[i] - reference
+        with np.errstate(invalid="ignore"):
+            return self.S[i] / np.where(reference == 0, 1, reference)
+
+    def sparam(self, sparam: str) -> np.ndarray:
+        """
+        Returns a (n_done, n_points) view of the complex data of one S parameter for the steps measured so far.
+        """
+        return self.S[:self.n_done, self.sparams.index(sparam)]
+
+    def normalized(self, sparam: str) -> np.ndarray:
+        """
+        Returns a (n_done, n_points) view of the normalized data of one S parameter for the steps measured so far.
+        """
+        if self.dS is None:
+            raise ValueError("The sweep is not normalized to the reference field (reference_mode is none)")
+        return self.dS[:self.n_done, self.sparams.index(sparam)]
+
+    def grid(self, sparam: str) -> np.ndarray:
+        """
+        Returns a (n_angles, n_fields, n_points) copy of the complex data of one S parameter, steps not measured yet are 0.
+        """
+        return self.S[self.grid_steps, self.sparams.index(sparam)]
+
+    def amplitude(self, sparam: str) -> np.ndarray:
+        return np.abs(self.sparam(sparam))
+
+    def phase(self, sparam: str) -> np.ndarray:
+        return np.angle(self.sparam(sparam))
+
+
+def measurement_dataframe(currents: list[float], currents1: list[float], currents2: list[float], freqs: list[float], fields: list[float], amps: list[float], phases: list[float], S, dS=None) -> pd.DataFrame:
+    """
+    Builds the DataFrame with the columns of the measurement CSV files, one row per (field, frequency) point.
+    The normalized traces dS are added as the last column if given.
+    """
+    df = pd.DataFrame(dict(zip(CSV_COLUMNS, [freqs, fields, currents, currents1, currents2, amps, phases, S])))
+    if dS is not None:
+        df[NORMALIZED_COLUMN] = dS
+    return df
+
 def save_data(currents: list[float], currents1: list[float], currents2: list[float], freqs: list[float], fields: list[float], amps: list[float], phases: list[float], S, user_folder: str, sample_folder: str, measurement_name: str):
     """
     Saves data in as {root_folder}/{user_folder}/{sample_folder}/{measurement_name}, checks if existing measurements exist already and adds a suffix
     """
-    df = pd.DataFrame()
-    df["Frequency"] = freqs
-    df["Field"] = fields
-    df["Current (dipole mode)"] = currents
-    df["Current1 (quadrupole mode)"] = currents1
-    df["Current2 (quadrupole mode)"] = currents2
-    df["Amplitude"] = amps
-    df["Phase"] = phases
-    df["S_param"] = S
+    df = measurement_dataframe(currents, currents1, currents2, freqs, fields, amps, phases, S)
 
     root_folder = f"{c.DATA_FOLDER_NAME}/"
     initialname = measurement_name
@@ -36,27 +143,272 @@ def save_data(currents: list[float], currents1: list[float], currents2: list[flo
     df.to_csv(f"{root_folder}/{user_folder}/{sample_folder}/{measurement_name}/{measurement_name}{format}", sep=',', index=False)
     logging.info(f"Data saved to {root_folder}/{user_folder}/{sample_folder}/{measurement_name}/{measurement_name}{format}")
 
-def load_measurement(measurement_path: str, transpose: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+class IncrementalWriter:
+    """
+    Writes a SweepData to the usual {measurement_name}_{sparam} folders while the sweep is running.
+    Each call to append_step appends only the rows of the new field step to the CSV files and fsyncs them, so a crash keeps all finished steps.
+    If the sweep is normalized to the reference field, the normalized traces are written in an extra NORMALIZED_COLUMN.
+    The metadata is written once when the writer is created and replaced atomically by close with the number of completed steps.
+    """
+
+    def __init__(self, sweep: SweepData, settings: dict, user_folder: str, sample_folder: str, measurement_name: str) -> None:
+        self.sweep = sweep
+        self.settings = settings
+        self.user_folder = user_folder
+        self.sample_folder = sample_folder
+        self.measurement_name = measurement_name
+        self.files = {}
+
+        for sparam in sweep.sparams:
+            name = f"{measurement_name}_{sparam}"
+            measurement_path = os.path.join(c.DATA_FOLDER_NAME, user_folder, sample_folder, name)
+            os.makedirs(measurement_path, exist_ok=True)
+
+            f = open(os.path.join(measurement_path, f"{name}.csv"), "w", newline="")
+            columns = CSV_COLUMNS if sweep.dS is None else CSV_COLUMNS + [NORMALIZED_COLUMN]
+            pd.DataFrame(columns=columns).to_csv(f, sep=',', index=False)
+            self._sync(f)
+            self.files[sparam] = f
+
+        self.save_metadata(completed_steps=0)
+
+    def _sparam_settings(self, sparam: str) -> dict:
+        sparam_settings = dict(self.settings)
+        sparam_settings["user_name"] = self.user_folder
+        sparam_settings["sample_name"] = self.sample_folder
+        sparam_settings["measurement_name"] = f"{self.measurement_name}_{sparam}"
+        sparam_settings["s_parameter"] = sparam
+        return sparam_settings
+
+    def save_metadata(self, completed_steps: int) -> None:
+        for sparam in self.sweep.sparams:
+            sparam_settings = self._sparam_settings(sparam)
+            sparam_settings["completed_steps"] = completed_steps
+            save_metadata(sparam_settings)
+
+    def append_step(self, i: int) -> None:
+        """
+        Appends the rows of field step i to every CSV file.
+        """
+        sweep = self.sweep
+        n_points = len(sweep.freqs)
+        current, current1, current2 = sweep.currents[i]
+
+        for k, sparam in enumerate(sweep.sparams):
+            S = sweep.S[i, k]
+            df = measurement_dataframe(
+                np.full(n_points, current), np.full(n_points, current1), np.full(n_points, current2),
+                sweep.freqs_at(i), np.full(n_points, sweep.fields[i]), np.abs(S), np.angle(S), S.astype(complex),
+                None if sweep.dS is None else sweep.dS[i, k].astype(complex)
+            )
+            f = self.files[sparam]
+            df.to_csv(f, sep=',', index=False, header=False)
+            self._sync(f)
+
+        logging.info(f"Field step {i} appended to {self.measurement_name}")
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.save_metadata(completed_steps=self.sweep.n_done)
+
+    @staticmethod
+    def _sync(f) -> None:
+        f.flush()
+        os.fsync(f.fileno())
+
+class HDF5Writer:
+    """
+    Writes a SweepData to a single chunked HDF5 file {measurement_name}.h5 while the sweep is running.
+    There is one (n_fields, n_points) complex dataset per S parameter, the frequency, field and current axes are stored once
+    and the settings are stored as attributes. Every dataset is chunked by field step, so append_step touches one chunk per dataset.
+    If the sweep is normalized to the reference field, the normalized traces of every S parameter go to a {sparam}_normalized dataset.
+    measurement_info.json is written next to the file as for the CSV files.
+    """
+
+    def __init__(self, sweep: SweepData, settings: dict, user_folder: str, sample_folder: str, measurement_name: str) -> None:
+        self.sweep = sweep
+        self.settings = dict(settings, user_name=user_folder, sample_name=sample_folder, measurement_name=measurement_name)
+        self.measurement_path = create_measurement_path(self.settings)
+        os.makedirs(self.measurement_path, exist_ok=True)
+
+        n_fields, n_sparams, n_points = sweep.S.shape
+        self.file = h5py.File(os.path.join(self.measurement_path, f"{measurement_name}.h5"), "w")
+        self.file.create_dataset("fields", data=sweep.fields)
+        self.file.create_dataset("angles", data=sweep.angles)
+        self.file.create_dataset("grid_steps", data=sweep.grid_steps)
+        self.file.create_dataset("freqs", shape=(n_points,), dtype=sweep.freqs.dtype)
+        self.file.create_dataset("currents", shape=sweep.currents.shape, dtype=sweep.currents.dtype, chunks=(1, 3))
+        if sweep.step_freqs is not None:
+            self.file.create_dataset("step_freqs", shape=sweep.step_freqs.shape, dtype=sweep.step_freqs.dtype, chunks=(1, n_points))
+        for sparam in sweep.sparams:
+            self.file.create_dataset(sparam, shape=(n_fields, n_points), dtype=sweep.S.dtype, chunks=(1, n_points))
+            if sweep.dS is not None:
+                self.file.create_dataset(f"{sparam}_normalized", shape=(n_fields, n_points), dtype=sweep.dS.dtype, chunks=(1, n_points))
+
+        for key, value in self.settings.items():
+            if key != "field_sweep" and isinstance(value, (str, int, float, bool)):
+                self.file.attrs[key] = value
+        self.file.attrs["sparams"] = sweep.sparams
+        self.file.attrs["completed_steps"] = 0
+        self.file.flush()
+
+        self.save_metadata(completed_steps=0)
+
+    def save_metadata(self, completed_steps: int) -> None:
+        save_metadata(dict(self.settings, storage_format="hdf5", completed_steps=completed_steps))
+
+    def append_step(self, i: int) -> None:
+        """
+        Writes field step i to every dataset.
+        """
+        sweep = self.sweep
+        if i == 0:
+            self.file["freqs"][:] = sweep.freqs
+        self.file["currents"][i] = sweep.currents[i]
+        if sweep.step_freqs is not None:
+            self.file["step_freqs"][i] = sweep.step_freqs[i]
+        for k, sparam in enumerate(sweep.sparams):
+            self.file[sparam][i] = sweep.S[i, k]
+            if sweep.dS is not None:
+                self.file[f"{sparam}_normalized"][i] = sweep.dS[i, k]
+        self.file.attrs["completed_steps"] = sweep.n_done
+        self.file.flush()
+
+        logging.info(f"Field step {i} written to {self.settings['measurement_name']}.h5")
+
+    def close(self) -> None:
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.save_metadata(completed_steps=self.sweep.n_done)
+
+def writer_output_paths(settings: dict, sparams: list[str]) -> list[str]:
+    """
+    Returns the folders create_writer writes a measurement to: the measurement folder for HDF5, one {measurement_name}_{sparam} folder per S parameter for CSV.
+    """
+    measurement_path = create_measurement_path(settings)
+    if settings.get("storage_format", c.STORAGE_FORMAT) == "csv":
+        return [f"{measurement_path}_{sparam}" for sparam in sparams]
+    return [measurement_path]
+
+def create_writer(sweep: SweepData, settings: dict, user_folder: str, sample_folder: str, measurement_name: str) -> IncrementalWriter | HDF5Writer:
+    """
+    Returns the writer for the storage format selected in the settings ("hdf5" or "csv"), CONSTANTS.STORAGE_FORMAT is used if it is not set.
     """
-    Reads data from CSV file.
+    storage_format = settings.get("storage_format", c.STORAGE_FORMAT)
+    if storage_format == "hdf5":
+        return HDF5Writer(sweep, settings, user_folder, sample_folder, measurement_name)
+    elif storage_format == "csv":
+        return IncrementalWriter(sweep, settings, user_folder, sample_folder, measurement_name)
+    else:
+        raise ValueError(f"Unknown storage format: {storage_format}")
+
+def open_measurement_store(measurement_path: str) -> h5py.File:
+    """
+    Opens the HDF5 file of a measurement read-only.
+    Nothing is read until a dataset is sliced, e.g. store["S21"][10:20, 500:1000] reads only the chunks of field steps 10 to 19.
+    The caller is responsible for closing the file, preferably with a with statement.
+    """
+    metadata = load_metadata(measurement_path)
+    return h5py.File(os.path.join(measurement_path, f"{metadata['measurement_name']}.h5"), "r")
+
+def load_measurement(measurement_path: str, transpose: bool = False, sparam: str | None = None, field_slice: slice = slice(None), freq_slice: slice = slice(None), dtype=None, normalized: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Reads data from CSV file or HDF5 store.
     Takes filename as input and returns relevant data.
     Information about the measurement is given by the metadata.
+    Only the field steps in field_slice and the frequency points in freq_slice are returned, for HDF5 measurements
+    the rest is not read from disk and sparam selects the dataset (default: the S parameter in the metadata).
+    For measurements whose frequency points change from step to step (frequency_mode "adaptive" or "tracking") freqs has shape (n_fields, n_freq),
+    steps measured with fewer points are padded with NaN.
+    A ValueError is raised if no measured field step is selected.
+    dtype sets the type of the CSV amplitude and phase arrays, e.g. "float32" to halve the memory of large measurements.
+    With normalized the amplitude and phase of the traces normalized to the reference field are returned instead of the raw ones.
     """
     with open(os.path.join(measurement_path, "measurement_info.json"), "r") as f:
         metadata = json.load(f)
 
+    if normalized and metadata.get("reference_mode", "none") == "none":
+        raise ValueError(f"The measurement in {measurement_path} was not normalized to the reference field")
+
+    if metadata.get("storage_format") == "hdf5":
+        return load_measurement_hdf5(measurement_path, metadata, transpose, sparam, field_slice, freq_slice, normalized)
+
+    if normalized:
+        data, fields = load_measurement_columns(measurement_path, ["Frequency", NORMALIZED_COLUMN], None, field_slice, metadata)
+        dS = data[NORMALIZED_COLUMN][:, freq_slice]
+        amps, phases = np.abs(dS), np.angle(dS)
+        if dtype:
+            amps, phases = amps.astype(dtype), phases.astype(dtype)
+    else:
+        dtypes = {"Frequency": "float64", "Amplitude": dtype, "Phase": dtype} if dtype else None
+        data, fields = load_measurement_columns(measurement_path, ["Frequency", "Amplitude", "Phase"], dtypes, field_slice, metadata)
+        amps = data["Amplitude"][:, freq_slice]
+        phases = data["Phase"][:, freq_slice]
+    if len(fields) == 0:
+        raise ValueError(f"No measured field steps of {measurement_path} are selected by {field_slice}")
+    freqs = data["Frequency"][0, freq_slice] if metadata.get("frequency_mode", "uniform") == "uniform" else data["Frequency"][:, freq_slice]
+
+    if transpose:
+        amps = np.transpose(amps)
+        phases = np.transpose(phases)
+
+    logging.info(f"Measurement data loaded from {measurement_path}")
+
+    return freqs, fields, amps, phases
+
+def load_measurement_columns(measurement_path: str, columns: list[str], dtype: dict | None = None, field_slice: slice = slice(None), metadata: dict | None = None) -> tuple[dict[str, np.ndarray], np.ndarray]:
+    """
+    Reads the chosen columns of a CSV measurement and reshapes each of them to (n_fields, n_freq).
+    The rows are stored field step by field step in the order of the field sweep, so no filtering on the Field column is needed
+    and repeated field values (like the reference field) are kept apart. Only the rows of the field steps in field_slice are parsed.
+    dtype maps column names to types for pandas, the S_param and NORMALIZED_COLUMN columns are converted to complex.
+    Returns the dict of arrays and the field values of the loaded steps.
+    """
+    if metadata is None:
+        metadata = load_metadata(measurement_path)
+
     fields = np.array(metadata["field_sweep"])
-    n_field_points = len(fields)
-    n_freq_points = metadata["number_of_points"]
+    n_freq_points = metadata.get("points_per_step", metadata["number_of_points"])
     measurement_name = metadata["measurement_name"]
 
-    df = pd.read_csv(os.path.join(measurement_path, f"{measurement_name}.csv"))
-    freqs = (df.loc[df["Field"] == fields[0]])["Frequency"]
-    amps, phases = np.zeros((n_field_points, n_freq_points)), np.zeros((n_field_points, n_freq_points))
-    
-    for i, field in enumerate(fields):
-        amps[i, :] = (df.loc[df["Field"] == field])["Amplitude"]
-        phases[i, :] = (df.loc[df["Field"] == field])["Phase"]
+    start, stop, step = field_slice.indices(len(fields))
+    if step < 1:
+        raise ValueError("field_slice must have a positive step")
+    stop = max(start, stop)
+    df = pd.read_csv(
+        os.path.join(measurement_path, f"{measurement_name}.csv"),
+        usecols=columns,
+        dtype=dtype,
+        skiprows=range(1, start * n_freq_points + 1),
+        nrows=(stop - start) * n_freq_points,
+    )
+
+    n_read = len(df) // n_freq_points    # an interrupted measurement has fewer field steps than the sweep
+    data = {}
+    for column in columns:
+        values = df[column].to_numpy()[:n_read * n_freq_points]
+        if column in ("S_param", NORMALIZED_COLUMN):
+            values = values.astype(complex)
+        data[column] = values.reshape(n_read, n_freq_points)[::step]
+
+    return data, fields[start:start + n_read][::step]
+
+def load_measurement_hdf5(measurement_path: str, metadata: dict, transpose: bool = False, sparam: str | None = None, field_slice: slice = slice(None), freq_slice: slice = slice(None), normalized: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    sparam = sparam if sparam else metadata["s_parameter"]
+
+    with open_measurement_store(measurement_path) as store:
+        completed_steps = store.attrs["completed_steps"]
+        field_slice = slice(*field_slice.indices(completed_steps))
+        freqs = store["step_freqs"][field_slice, freq_slice] if "step_freqs" in store else store["freqs"][freq_slice]
+        fields = store["fields"][field_slice]
+        if len(fields) == 0:
+            raise ValueError(f"No measured field steps of {measurement_path} are selected by {field_slice}")
+        S = store[f"{sparam}_normalized" if normalized else sparam][field_slice, freq_slice]
+
+    amps, phases = np.abs(S), np.angle(S)
 
     if transpose:
         amps = np.transpose(amps)
@@ -66,6 +418,17 @@ def load_measurement(measurement_path: str, transpose: bool = False) -> tuple[np
 
     return freqs, fields, amps, phases
 
+def write_json_atomic(path: str, obj: object) -> None:
+    """
+    Writes a JSON file through a temporary file in the same folder, so readers see either the old or the new content.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 def save_metadata(settings: object) -> None:
     user_folder = settings["user_name"]
     sample_name = settings["sample_name"]
@@ -76,8 +439,7 @@ def save_metadata(settings: object) -> None:
 
     measurement_path = create_measurement_path(settings)
     os.makedirs(measurement_path, exist_ok=True)
-    with open(os.path.join(measurement_path, "measurement_info.json"), 'w') as f:
-        json.dump(settings, f, indent=4)
+    write_json_atomic(os.path.join(measurement_path, "measurement_info.json"), settings)
     logging.info(f"Metadata saved to {measurement_path}")
 
 def load_metadata(measurement_path: str) -> object:
@@ -0,0 +1,276 @@
+import numpy as np
+import logging
+from dataclasses import dataclass, fields as dataclass_fields
+from concurrent.futures import ProcessPoolExecutor
+
+from library_file_management import load_measurement, load_metadata
+import CONSTANTS as c
+
+"""
+This library fits FMR lines to all the traces of a sweep at once.
+Every trace is fitted with the same line shape by a Levenberg-Marquardt least squares that works on a whole stack of traces in numpy,
+so a sweep costs a few dozen array operations instead of one scipy fit per field step. The line shapes are
+    "complex"     S(f) = offset + a * w / (f_res - f - i w), the complex susceptibility seen in the complex traces S or in the traces
+                  normalized to the reference field, a and offset are complex
+    "lorentzian"  |S|(f) = offset + a * w^2 / ((f - f_res)^2 + w^2), for amplitude traces
+where w is the half width at half maximum, the linewidth returned is the full width 2w.
+Points where the frequency or the data is NaN, like the padding of the shorter steps of a tracking sweep, are left out of the fit.
+On Windows the process pool starts new interpreters that import the calling script, so scripts calling fit_sweep with workers
+need the usual if __name__ == "__main__": guard.
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODELS = ["complex", "lorentzian"]
+
+@dataclass
+class FitResult:
+    """
+    Fitted parameters of n traces, every field is an array of length n. The errors are one standard deviation, estimated from the
+    covariance of the fit scaled by the reduced chi-square. converged is False where the fit stopped at max_iterations,
+    or where the resonance ended on the edge of the measured span or the linewidth on its bounds (see fit_traces).
+    Traces with too few valid points to fit have NaN parameters and converged False.
+    """
+    f_res: np.ndarray
+    f_res_err: np.ndarray
+    linewidth: np.ndarray
+    linewidth_err: np.ndarray
+    amplitude: np.ndarray
+    amplitude_err: np.ndarray
+    phase: np.ndarray
+    offset: np.ndarray
+    rms_residual: np.ndarray
+    converged: np.ndarray
+
+    @classmethod
+    def concatenate(cls, results: list["FitResult"]) -> "FitResult":
+        return cls(**{field.name: np.concatenate([getattr(result, field.name) for result in results]) for field in dataclass_fields(cls)})
+
+    @classmethod
+    def unfitted(cls, n: int, model: str) -> "FitResult":
+        values = {field.name: np.full(n, np.nan) for field in dataclass_fields(cls)}
+        values["offset"] = np.full(n, complex(np.nan, np.nan) if model == "complex" else np.nan)
+        values["converged"] = np.zeros(n, dtype=bool)
+        return cls(**values)
+
+    def insert(self, rows: np.ndarray, result: "FitResult") -> None:
+        for field in dataclass_fields(self):
+            getattr(self, field.name)[rows] = getattr(result, field.name)
+
+def _line(x: np.ndarray, p: np.ndarray, model: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the line shape at x (n, m) for the parameters p (n, n_params) and its derivatives (n, m, n_params).
+    """
+    f_res, w = p[:, 0:1], p[:, 1:2]
+    if model == "complex":
+        a, offset = p[:, 2:3] + 1j * p[:, 3:4], p[:, 4:5] + 1j * p[:, 5:6]
+        D = f_res - x - 1j * w
+        L = w / D
+        jacobian = np.stack([-a * w / D**2, a * (f_res - x) / D**2, L, 1j * L, np.ones_like(L), np.full_like(L, 1j)], axis=-1)
+        return offset + a * L, jacobian
+
+    a, offset = p[:, 2:3], p[:, 3:4]
+    u = x - f_res
+    denominator = u**2 + w**2
+    L = w**2 / denominator
+    jacobian = np.stack([a * 2 * u * w**2 / denominator**2, a * 2 * w * u**2 / denominator**2, L, np.ones_like(L)], axis=-1)
+    return offset + a * L, jacobian
+
+def _residuals(x: np.ndarray, y: np.ndarray, valid: np.ndarray, p: np.ndarray, model: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the real residuals (n, m) or (n, 2m) of the model against y and their jacobian, both 0 at the points that are not valid.
+    """
+    values, jacobian = _line(x, p, model)
+    difference = np.where(valid, values - y, 0)
+    jacobian = np.where(valid[:, :, None], jacobian, 0)
+    if model == "complex":
+        return np.concatenate([difference.real, difference.imag], axis=1), np.concatenate([jacobian.real, jacobian.imag], axis=1)
+    return difference, jacobian
+
+def _initial_guess(x: np.ndarray, y: np.ndarray, valid: np.ndarray, model: str, dip: bool = False, x_guess: np.ndarray | None = None, guess_window: float = np.inf) -> np.ndarray:
+    """
+    Takes the point furthest from the median of each trace, or with dip the point where the magnitude drops furthest below it,
+    as the resonance, within guess_window of x_guess if given, and the points around it above half of its deviation as the line.
+    """
+    rows = np.arange(len(y))
+    y = np.where(valid, y, np.nan)
+    offset = np.nanmedian(y.real, axis=1) + (1j * np.nanmedian(y.imag, axis=1) if model == "complex" else 0)
+    if dip:
+        deviation = np.abs(offset)[:, None] - np.abs(y) if model == "complex" else offset[:, None] - y
+    else:
+        deviation = np.abs(y - offset[:, None])
+    deviation = np.where(valid, deviation, -np.inf)
+
+    if x_guess is None:
+        peak = np.argmax(deviation, axis=1)
+    else:
+        distance = np.where(valid, np.abs(x - x_guess[:, None]), np.inf)
+        near = distance <= guess_window
+        peak = np.where(np.any(near, axis=1), np.argmax(np.where(near, deviation, -np.inf), axis=1), np.argmin(distance, axis=1))
+
+    # length of the run of points above half maximum that contains the peak
+    index = np.arange(x.shape[1])
+    below = deviation <= deviation[rows, peak, None] / 2
+    left = np.maximum.accumulate(np.where(below, index, -1), axis=1)[rows, peak]
+    right = np.minimum.accumulate(np.where(below, index, x.shape[1])[:, ::-1], axis=1)[:, ::-1][rows, peak]
+    spacing = np.abs(np.nanmedian(np.diff(np.where(valid, x, np.nan), axis=1), axis=1))
+    width = np.maximum((right - left - 1) * spacing / 2, spacing)
+    a = y[rows, peak] - offset
+    if model == "complex":
+        a = a / 1j    # the line shape is i at the resonance
+        return np.stack([x[rows, peak], width, a.real, a.imag, offset.real, offset.imag], axis=1)
+    return np.stack([x[rows, peak], width, a, offset], axis=1)
+
+def fit_traces(freqs: np.ndarray, data: np.ndarray, model: str = c.FIT_MODEL, f_guess: np.ndarray | None = None, guess_window: float = c.FIT_GUESS_WINDOW, dip: bool = False, max_iterations: int = c.FIT_MAX_ITERATIONS, tolerance: float = c.FIT_TOLERANCE) -> FitResult:
+    """
+    Fits the line shape model to every trace in data (n_traces, n_points), complex for "complex" and real for "lorentzian".
+    freqs has shape (n_points,) or (n_traces, n_points) for traces with their own frequency points.
+    The fit starts from the strongest feature of every trace, or from the strongest one within guess_window Hz of f_guess (one
+    frequency per trace). With dip only drops of the magnitude count as features, as for an absorption line in transmission:
+    in traces divided by the reference field trace the line of the reference field is a rise, so it is skipped.
+    The resonance is kept within the measured span of each trace and the linewidth between a fiftieth of the point spacing
+    and the span, a fit that ends on one of these bounds is reported as not converged.
+    All the traces are fitted together, a trace drops out of the iterations once its chi-square changes by less than tolerance.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown line shape model: {model}")
+    data = np.asarray(data, dtype=complex if model == "complex" else float)
+    freqs = np.broadcast_to(np.asarray(freqs, dtype=float), data.shape)
+    valid = np.isfinite(freqs) & np.isfinite(data)
+
+    # a trace needs at least as many residuals as parameters, an all NaN one (e.g. a step that was not measured) has none
+    n_parameters = 6 if model == "complex" else 4
+    fittable = np.sum(valid, axis=1) * (2 if model == "complex" else 1) >= n_parameters
+    if not np.all(fittable):
+        result = FitResult.unfitted(len(data), model)
+        if np.any(fittable):
+            f_guess = None if f_guess is None else np.broadcast_to(np.asarray(f_guess, dtype=float), len(data))[fittable]
+            result.insert(fittable, fit_traces(freqs[fittable], data[fittable], model, f_guess, guess_window, dip, max_iterations, tolerance))
+        return result
+
+    # the fit works on frequencies scaled to about [-1, 1], so all the parameters have similar magnitudes
+    f_min, f_max = np.min(freqs, where=valid, initial=np.inf), np.max(freqs, where=valid, initial=-np.inf)
+    center = (f_max + f_min) / 2
+    scale = max((f_max - f_min) / 2, np.finfo(float).tiny)
+    x = np.where(valid, (freqs - center) / scale, 0)
+    data = np.where(valid, data, 0)
+
+    x_low, x_high = np.min(x, axis=1, where=valid, initial=np.inf), np.max(x, axis=1, where=valid, initial=-np.inf)
+    spacing = np.abs(np.nanmedian(np.diff(np.where(valid, x, np.nan), axis=1), axis=1))
+    w_low, w_high = spacing / 100, (x_high - x_low) / 2
+
+    def bound(p: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        p[:, 0] = np.clip(p[:, 0], x_low[rows], x_high[rows])
+        p[:, 1] = np.clip(p[:, 1], w_low[rows], w_high[rows])
+        return p
+
+    x_guess = None if f_guess is None else (np.broadcast_to(np.asarray(f_guess, dtype=float), len(data)) - center) / scale
+    all_rows = np.arange(len(data))
+    p = bound(_initial_guess(x, data, valid, model, dip, x_guess, guess_window / scale), all_rows)
+    r, J = _residuals(x, data, valid, p, model)
+    cost = np.sum(r**2, axis=1)
+    damping = np.full(len(data), 1e-3)
+    converged = np.zeros(len(data), dtype=bool)
+
+    for _ in range(max_iterations):
+        active = np.flatnonzero(~converged)
+        if len(active) == 0:
+            break
+        J_active = J[active]
+        JT = J_active.transpose(0, 2, 1)
+        JTJ = JT @ J_active
+        gradient = (JT @ r[active, :, None])[:, :, 0]
+        diagonal = np.einsum("npp->np", JTJ)
+        A = JTJ + (damping[active, None] * diagonal + np.finfo(float).eps)[:, :, None] * np.eye(p.shape[1])
+        step = np.linalg.solve(A, -gradient[:, :, None])[:, :, 0]
+
+        p_new = bound(p[active] + step, active)
+        r_new, J_new = _residuals(x[active], data[active], valid[active], p_new, model)
+        cost_new = np.sum(r_new**2, axis=1)
+
+        better = cost_new <= cost[active]
+        accepted = active[better]
+        converged[accepted] = cost[accepted] - cost_new[better] <= tolerance * np.maximum(cost[accepted], np.finfo(float).tiny)
+        p[accepted], r[accepted], J[accepted], cost[accepted] = p_new[better], r_new[better], J_new[better], cost_new[better]
+        damping[accepted] /= 10
+        damping[active[~better]] *= 10
+        converged[active[~better]] |= damping[active[~better]] > 1e10   # no step lowers the chi-square any more
+
+    converged &= (p[:, 0] > x_low) & (p[:, 0] < x_high) & (p[:, 1] > w_low) & (p[:, 1] < w_high)
+
+    n_residuals = np.sum(valid, axis=1) * (2 if model == "complex" else 1)
+    degrees_of_freedom = np.maximum(n_residuals - p.shape[1], 1)
+    covariance = np.linalg.pinv(J.transpose(0, 2, 1) @ J) * (cost / degrees_of_freedom)[:, None, None]
+    errors = np.sqrt(np.abs(np.einsum("npp->np", covariance)))
+
+    if model == "complex":
+        a, a_err = p[:, 2] + 1j * p[:, 3], np.hypot(p[:, 2] * errors[:, 2], p[:, 3] * errors[:, 3]) / np.maximum(np.hypot(p[:, 2], p[:, 3]), np.finfo(float).tiny)
+        offset = p[:, 4] + 1j * p[:, 5]
+    else:
+        a, a_err, offset = p[:, 2], errors[:, 2], p[:, 3]
+
+    return FitResult(
+        f_res=p[:, 0] * scale + center,
+        f_res_err=errors[:, 0] * scale,
+        linewidth=2 * p[:, 1] * scale,
+        linewidth_err=2 * errors[:, 1] * scale,
+        amplitude=np.abs(a),
+        amplitude_err=a_err,
+        phase=np.angle(a),
+        offset=offset,
+        rms_residual=np.sqrt(cost / np.maximum(n_residuals, 1)),
+        converged=converged,
+    )
+
+def fit_sweep(freqs: np.ndarray, data: np.ndarray, model: str = c.FIT_MODEL, f_guess: np.ndarray | None = None, guess_window: float = c.FIT_GUESS_WINDOW, dip: bool = False, workers: int | None = c.FIT_WORKERS, chunk_size: int = c.FIT_CHUNK_SIZE, max_iterations: int = c.FIT_MAX_ITERATIONS, tolerance: float = c.FIT_TOLERANCE) -> FitResult:
+    """
+    Fits all the traces of a sweep, like fit_traces, in chunks of chunk_size traces to bound the memory of the jacobians.
+    With workers > 1 the chunks are fitted in a pool of that many processes, None or 1 fits them in this process.
+    """
+    data = np.asarray(data)
+    freqs = np.asarray(freqs)
+    starts = range(0, len(data), chunk_size)
+    f_guess = None if f_guess is None else np.broadcast_to(np.asarray(f_guess, dtype=float), len(data))
+    chunks = [
+        (freqs if freqs.ndim == 1 else freqs[k:k + chunk_size], data[k:k + chunk_size], model,
+         None if f_guess is None else f_guess[k:k + chunk_size], guess_window, dip, max_iterations, tolerance)
+        for k in starts
+    ]
+
+    if workers and workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            results = list(executor.map(fit_traces, *zip(*chunks)))
+    else:
+        results = [fit_traces(*chunk) for chunk in chunks]
+
+    result = FitResult.concatenate(results)
+    logger.info(f"Fitted {len(data)} traces with the {model} line shape, {np.sum(~result.converged)} did not converge.")
+    return result
+
+def fit_measurement(measurement_path: str, sparam: str | None = None, model: str = c.FIT_MODEL, normalized: bool = True, field_slice: slice = slice(None), freq_slice: slice = slice(None), f_guess=None, dip: bool | None = None, workers: int | None = c.FIT_WORKERS) -> tuple[np.ndarray, FitResult]:
+    """
+    Loads a measurement with load_measurement and fits every field step. With normalized the steps of the reference field,
+    which are normalized to themselves and have no line, are skipped.
+    dip defaults to True for transmission S parameters normalized by division, so the line of the reference field is not fitted.
+    f_guess is passed to fit_sweep, it can also be a function giving the expected resonance frequency in Hz for an array of fields in mT.
+    Returns the fields of the fitted steps and the FitResult.
+    """
+    metadata = load_metadata(measurement_path)
+    sparam = sparam if sparam else metadata["s_parameter"]
+    freqs, fields, amps, phases = load_measurement(measurement_path, sparam=sparam, field_slice=field_slice, freq_slice=freq_slice, normalized=normalized)
+    data = amps * np.exp(1j * phases)
+
+    if normalized:
+        identity = 1 if metadata.get("reference_mode", "none") == "divide" else 0
+        fitted = ~np.all(np.isnan(data) | np.isclose(data, identity, rtol=0, atol=1e-6), axis=1)
+        fields, data = fields[fitted], data[fitted]
+        freqs = freqs if freqs.ndim == 1 else freqs[fitted]
+    if dip is None:
+        dip = normalized and metadata.get("reference_mode", "none") == "divide" and sparam[1] != sparam[2]
+
+    if model != "complex":
+        data = np.abs(data)
+    if callable(f_guess):
+        f_guess = f_guess(fields)
+    return fields, fit_sweep(freqs, data, model, f_guess, dip=dip, workers=workers)
@@ -238,6 +238,26 @@ class GUI_input_text_field_sweep(GUI_input_text):
         self.clear()
         self.entry_var.insert(0, str(list(np.array(content)[1:])))
     
+
+
+class GUI_input_text_angle_sweep(GUI_input_text_field_sweep):
+    # Accepts one angle or several angles in the notation of the field sweep, several angles give a sweep over (angle, field)
+
+    def is_valid(self):
+        if self.get() is None:
+            return False, "Angle must be a number, a list of numbers or start:step:stop"
+        return True, None
+
+    def get(self):
+        angles = super().get()
+        if angles is None or len(angles) == 0:
+            return None
+        return angles if len(angles) > 1 else angles[0]
+
+    def write(self, content):
+        self.clear()
+        self.entry_var.insert(0, str(content))
+
         
 class GUI_input_text_to_freq(GUI_input_text):
 
@@ -431,7 +451,7 @@ def gui_measurement_startup():
         GUI_input_combobox_dipole_mode( gui=gui,    param_name="dipole_mode",          param_desc="Dipole mode",           values=[1, 2]),
         GUI_input_combobox(             gui=gui,    param_name="s_parameter",          param_desc="S Parameter",           values=["S11", "S22", "S33", "S44", "S12", "S21", "S13", "S31", "S23", "S32", "S24", "S42", "S34", "S43", "S14", "S41"]),
         GUI_input_text_field_sweep(     gui=gui,    param_name="field_sweep",          param_desc="Field sweep [mT]"       ),
-        GUI_input_text_to_number(       gui=gui,    param_name="angle",                param_desc="Angle [deg]",           ), 
+        GUI_input_text_angle_sweep(     gui=gui,    param_name="angle",                param_desc="Angle [deg]",           ), 
         GUI_input_text_to_freq(         gui=gui,    param_name="start_frequency",      param_desc="Start frequency [GHz]"  ),
         GUI_input_text_to_freq(         gui=gui,    param_name="stop_frequency",       param_desc="Stop frequency [GHz]"   ),
         GUI_input_text_to_number(       gui=gui,    param_name="number_of_points",     param_desc="Number of points",      func=lambda x : int(x)),
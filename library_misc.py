@@ -2,6 +2,9 @@ import os
 import numpy as np
 import json
 import matplotlib.pyplot as plt
+import threading
+from time import perf_counter
+from contextlib import contextmanager
 
 from logger import logger
 import CONSTANTS as c
@@ -35,6 +38,53 @@ def sendLog(s: str):
 
 
 
+class StageTimer:
+    """
+    Accumulates the time spent in the named stages of a measurement (ramp, settle, trigger, transfer, decode, persist).
+    Stages can be timed from several threads at once.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.totals = {}
+            self.counts = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                self.totals[name] = self.totals.get(name, 0) + elapsed
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def report(self, mean: bool = False) -> dict[str, float]:
+        """
+        Returns the total time in seconds spent in each stage, or the mean time per call with mean=True.
+        """
+        with self.lock:
+            if mean:
+                return {name: total / self.counts[name] for name, total in self.totals.items()}
+            return dict(self.totals)
+
+
+# Timer shared by the measurement libraries, read by the benchmarks
+stage_timer = StageTimer()
+
+
+def interpolate_complex(freqs: np.ndarray, ref_freqs: np.ndarray, ref_S: np.ndarray) -> np.ndarray:
+    """
+    Interpolates complex traces of shape (n_sparams, n_ref) given at ref_freqs onto freqs.
+    """
+    return np.array([np.interp(freqs, ref_freqs, S.real) + 1j * np.interp(freqs, ref_freqs, S.imag) for S in ref_S])
+
+
 def update_log(settings: object):
     with open("log.txt", "r") as f:
         text = f.read()
@@ -1,8 +1,13 @@
 from library_misc import *
-from time import sleep
+from time import sleep, perf_counter
+import threading
 import serial
+import numpy as np
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import CONSTANTS as c
+from library_simulation import SimulatedSerial
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
@@ -15,14 +20,15 @@ One can choose between using a F2031 single power supply, a F2031 pair of power
 
 class PowerSupply:
 
-    def __init__(self, port, baud_rate) -> None:
-        self.ser = serial.Serial(port, baud_rate)
+    def __init__(self, port, baud_rate, ser=None, timeout: float = c.PS_TIMEOUT) -> None:
+        self.ser = ser if ser is not None else serial.Serial(port, baud_rate, timeout=timeout)
+        self.ser.timeout = timeout
+        self.command_timer = StageTimer()   # round trip time of each command type
         logger.info(f"Power supply initialized on port {port} with baud rate {baud_rate}")
 
     def getID(self) -> None:
         logger.info('Getting power supply ID...')
-        self.ser.write(b'*IDN?\r') 
-        response = self.read_to_r()
+        response = self.query('*IDN?\r')
         logger.info(f"ID: {response}")
 
     def getConnectionStatus(self) -> None:
@@ -30,7 +36,7 @@ class PowerSupply:
             logger.info(f"Power supply connected on port {self.ser.name}")
 
     def setCurrent(self, i: float, give_additional_info=False) -> None:
-        maxCurrent = 3.6
+        maxCurrent = c.PS_MAX_CURRENT
 
         if abs(i) > maxCurrent:
             logger.error(f'Current {i}A exceeds max current of {maxCurrent}A')
@@ -41,9 +47,7 @@ class PowerSupply:
         if give_additional_info:
             logger.info(f'Query: {command}')
 
-        self.ser.write(bytes(command, 'utf-8'))
-
-        response = self.read_to_r()
+        response = self.query(command)
 
         if response != 'CMLT\r':
             logger.warning(f"Unexpected response in setCurrent: {response}")
@@ -55,65 +59,256 @@ class PowerSupply:
 
     def setOutputState(self, state: int) -> None:
         command = f'OUT {state}\r'
-        self.ser.write(bytes(command, 'utf-8'))
-
-        response = self.read_to_r()
+        response = self.query(command)
         if response != 'CMLT\r':
             logger.warning(f"Unexpected response in setOutputState: {response}")
 
+    def getCurrent(self) -> float:
+        """
+        Reads back the output current in A.
+        """
+        response = self.query(f'{c.PS_READBACK_COMMAND}\r')
+        return float(response.strip())
+
     def setRampRate(self, rate: float) -> None:
-        if rate < 0.01:
-            rate = 0.01
-            logger.warning("Using rate smaller than 0.01 A/s, using 0.01 A/s instead")
+        min_rate, max_rate = c.PS_RAMP_RATE_RANGE
+        if rate < min_rate:
+            logger.warning(f"Using rate smaller than {min_rate} A/s, using {min_rate} A/s instead")
 
-        if rate > 2:
-            rate = 2
-            logger.warning('Using rate greater than 2 A/s, using 2 A/s instead')
+        if rate > max_rate:
+            logger.warning(f'Using rate greater than {max_rate} A/s, using {max_rate} A/s instead')
+        rate = clampRampRate(rate)
 
         command = f'RATE {rate}\r'
         logger.info(f'Query: {command}')
 
-        self.ser.write(bytes(command, 'utf-8'))
-
-        response = self.read_to_r()
+        response = self.query(command)
         if response != 'CMLT\r':
             logger.warning(f"Unexpected response in setRampRate: {response}")
 
+    def query(self, command: str) -> str:
+        """
+        Sends a command terminated by \\r and returns the answer, the round trip time is added to command_timer.
+        """
+        with self.command_timer.stage(command.split()[0]):
+            self.ser.write(bytes(command, 'utf-8'))
+            return self.read_to_r()
+
     def read_to_r(self) -> str:
-        ch = ''
-        line = []
-        while ch != b'\r':
-            ch = self.ser.read()
-            line.append(ch.decode('utf-8'))
-        return ''.join(line)
+        """
+        Reads one answer up to and including \\r in a single call.
+        Raises TimeoutError if the \\r does not arrive within the timeout of the serial port.
+        """
+        line = self.ser.read_until(b'\r')
+        if not line.endswith(b'\r'):
+            raise TimeoutError(f"No answer from power supply on port {self.ser.name} within {self.ser.timeout}s, received: {line}")
+        return line.decode('utf-8')
+
+    def getLatencyReport(self) -> dict[str, float]:
+        """
+        Returns the mean round trip time in ms of each command type sent so far.
+        """
+        return {command: 1000 * mean for command, mean in self.command_timer.report(mean=True).items()}
 
     def closeConnection(self) -> None:
+        latency = ", ".join(f"{command} {ms:.1f} ms" for command, ms in self.getLatencyReport().items())
         self.ser.close()
         logger.info("Closed connection to power supply")
+        if latency:
+            logger.info(f"Mean command latency: {latency}")
 
     def demag_sweep(self) -> None:
-        demag_sweep = [3, -1.5, 0.75, -0.375, 0.1875, -0.09375, 0.045, -0.02, 0.01, -0.005, 0.002, -0.001, 0.0005]
-        logger.info("Executing demagnetizing sweep...")
-        
-        for current in demag_sweep:
-            self.setCurrent(current)
-            sleep(0.5)
-
-        self.setCurrent(0)
-        logger.info("Completed demagnetizing sweep.")
+        DemagTask([self]).wait()
 
     def setTriggers(self, val, give_additional_info=False) -> None:
-        command = f'SWTRIG n{val}'
-        if give_additional_info:
-            logger.info(f'Query: {command}')
+        """
+        Sets the number of trigger inputs the supply accepts to step through the loaded current list.
+        """
+        for command in (f'SWTRIG n{val}\r', f'NTRIG n{val}\r'):
+            if give_additional_info:
+                logger.info(f'Query: {command}')
+
+            response = self.query(command)
+            if response != 'CMLT\r':
+                logger.warning(f"Unexpected response in setTriggers: {response}")
+
+    def loadCurrentList(self, currents: list[float], give_additional_info=False) -> None:
+        """
+        Loads the currents of a triggered sweep into the supply, every trigger input moves the output to the next one.
+        The output is switched on, so the supply must already be at the current that comes before the list.
+        """
+        maxCurrent = c.PS_MAX_CURRENT
 
-        self.ser.write(bytes(command, 'utf-8'))
+        if np.max(np.abs(currents), initial=0) > maxCurrent:
+            raise ValueError(f'Current list exceeds max current of {maxCurrent}A')
+
+        command = f"{c.PS_LIST_COMMAND} {','.join(f'{i:+.5f}' for i in currents)}\r"
 
-        command = f'NTRIG n{val}'
         if give_additional_info:
             logger.info(f'Query: {command}')
 
-        self.ser.write(bytes(command, 'utf-8'))
+        response = self.query(command)
+        if response != 'CMLT\r':
+            logger.warning(f"Unexpected response in loadCurrentList: {response}")
+
+        self.setTriggers(len(currents), give_additional_info)
+        self.setOutputState(1)
+
+# Calibration of the magnet, field [mT] = conversion [mT/A] * current [A] + offset [mT], given as (offset, conversion)
+DIPOLE_CALIBRATION = (2.7001, 50.027)
+QUADRUPOLE_CALIBRATION = ((1.7091, 43.884), (1.4364, 42.473))
+
+def clampRampRate(rate: float) -> float:
+    """
+    Returns the ramp rate in A/s that the supplies really use for rate, they only accept rates within PS_RAMP_RATE_RANGE.
+    """
+    min_rate, max_rate = c.PS_RAMP_RATE_RANGE
+    return min(max(rate, min_rate), max_rate)
+
+def fieldToCurrents(field: float, angle: float, dipole: int) -> tuple[float, float, float]:
+    """
+    Converts a field in mT to the currents of the supplies.
+    Returns (dipole current, quadrupole current 1, quadrupole current 2), the currents not used by the dipole mode are 0.
+    In quadrupole mode the field is applied at angle (in degrees).
+    """
+    if dipole == 1:
+        offset, conversion = DIPOLE_CALIBRATION
+        return (field - offset) / conversion, 0, 0
+
+    if dipole == 2:
+        (offset1, conversion1), (offset2, conversion2) = QUADRUPOLE_CALIBRATION
+        angle_rad = np.radians(angle)
+        current1 = (field * np.cos(angle_rad) - offset1) / conversion1
+        current2 = (field * np.sin(angle_rad) - offset2) / conversion2
+        return 0, current1, current2
+
+    raise Exception("Invalid dipole_mode parameter")
+
+# Each power supply is on its own serial port, so commands to different supplies can run at the same time
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="PowerSupply")
+
+def runParallel(calls: list[tuple]) -> list:
+    """
+    Runs calls given as (function, *args) at the same time and waits for all of them, so it acts as a barrier.
+    Returns their results in order, the first exception is raised after all calls have finished.
+    """
+    futures = [_executor.submit(*call) for call in calls]
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error:
+            raise error
+    return [future.result() for future in futures]
+
+def setCurrents(supplies: list[PowerSupply], currents: list[float]) -> None:
+    """
+    Sets the current of several power supplies concurrently.
+    Returns when every supply has acknowledged its commands, so the settling time can start right after.
+    """
+    runParallel([(ps.setCurrent, current) for ps, current in zip(supplies, currents)])
+
+def waitForSettling(supplies: list[PowerSupply], currents: list[float], tolerance: float = c.SETTLING_TOLERANCE, timeout: float = c.SETTLING_TIMEOUT, poll_interval: float = c.SETTLING_POLL_INTERVAL) -> float:
+    """
+    Polls the current readback of the supplies until every one is within tolerance of its target and has changed by less than tolerance since the previous poll.
+    Gives up with a warning after timeout seconds. Returns the time waited in seconds.
+    """
+    start = perf_counter()
+    previous = None
+
+    while True:
+        readings = runParallel([(ps.getCurrent,) for ps in supplies])
+        on_target = all(abs(reading - current) < tolerance for reading, current in zip(readings, currents))
+        stable = previous is not None and all(abs(reading - last) < tolerance for reading, last in zip(readings, previous))
+        elapsed = perf_counter() - start
+
+        if on_target and stable:
+            return elapsed
+        if elapsed > timeout:
+            logger.warning(f"Currents {readings} did not settle to {currents} within {timeout}s")
+            return elapsed
+
+        previous = readings
+        sleep(poll_interval)
+
+def armTriggeredSweep(supplies: list[PowerSupply], currents: np.ndarray) -> None:
+    """
+    Loads the current lists of a triggered sweep into the supplies concurrently, currents has one column per supply.
+    """
+    currents = np.asarray(currents, dtype=float).reshape(len(currents), len(supplies))
+    runParallel([(ps.loadCurrentList, list(currents[:, k])) for k, ps in enumerate(supplies)])
+
+def disarmTriggeredSweep(supplies: list[PowerSupply]) -> None:
+    """
+    Stops the supplies from reacting to further trigger inputs.
+    """
+    runParallel([(ps.setTriggers, 0) for ps in supplies])
+
+def demagCurrents(start: float = c.DEMAG_START_CURRENT, n_steps: int = c.DEMAG_STEPS, decay: float = c.DEMAG_DECAY, shape: str = c.DEMAG_SHAPE) -> np.ndarray:
+    """
+    Currents of a demagnetizing sweep: n_steps values of alternating sign whose amplitude decays from start towards 0.
+        "table"      the fixed list DEMAG_TABLE, the sweep used before the profiles existed (start, n_steps and decay are ignored)
+        "geometric"  every amplitude is decay times the previous one
+        "linear"     the amplitude decreases by start / n_steps at every step
+    """
+    if shape == "table":
+        return np.array(c.DEMAG_TABLE, dtype=float)
+    steps = np.arange(n_steps)
+    if shape == "geometric":
+        amplitudes = start * decay ** steps
+    elif shape == "linear":
+        amplitudes = start * (1 - steps / n_steps)
+    else:
+        raise ValueError(f"Unknown demagnetizing profile: {shape}")
+    return amplitudes * (-1.0) ** steps
+
+class DemagTask:
+    """
+    Runs a demagnetizing sweep in a background thread, so the VNA can be configured in the meantime.
+    All supplies step through the currents together and end at 0 A, also when the task is cancelled.
+    An error in the background thread is raised again by wait.
+    """
+
+    def __init__(self, supplies: list[PowerSupply], currents: list[float] | None = None, step_time: float = c.DEMAG_STEP_TIME) -> None:
+        self.supplies = supplies
+        self.currents = demagCurrents() if currents is None else currents
+        self.step_time = step_time
+        self.cancelled = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="DemagTask", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        logger.info("Executing demagnetizing sweep...")
+        try:
+            for current in self.currents:
+                setCurrents(self.supplies, [current] * len(self.supplies))
+                if self.cancelled.wait(self.step_time):
+                    logger.warning("Demagnetizing sweep cancelled.")
+                    break
+            else:
+                logger.info("Completed demagnetizing sweep.")
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                setCurrents(self.supplies, [0] * len(self.supplies))
+            except Exception as e:
+                self.error = self.error or e
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def done(self) -> bool:
+        return not self.thread.is_alive()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """
+        Waits for the sweep to end and returns True if it ran to completion, False if it was cancelled or is still running after timeout.
+        """
+        self.thread.join(timeout)
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        return self.done() and not self.cancelled.is_set()
 
 @dataclass
 class TwoPowerSupply:
@@ -121,16 +316,18 @@ class TwoPowerSupply:
     ps2: PowerSupply
 
     def setCurrent(self, current):
-        self.ps1.setCurrent(current)
-        self.ps2.setCurrent(current)
+        setCurrents([self.ps1, self.ps2], [current, current])
 
     def demag_sweep(self):
-        self.ps1.demag_sweep()
-        self.ps2.demag_sweep()
+        DemagTask([self.ps1, self.ps2]).wait()
 
-def setupConnectionPS(port, baud_rate: int, give_additional_info=False) -> PowerSupply | None:
+def setupConnectionPS(port, baud_rate: int, give_additional_info=False, simulate: bool = False) -> PowerSupply | None:
+    """
+    Connects to the power supply on port.
+    With simulate=True a SimulatedSerial is used instead of the serial port.
+    """
     try:
-        ps = PowerSupply(port, baud_rate)
+        ps = PowerSupply(port, baud_rate, SimulatedSerial(port, baud_rate) if simulate else None)
         ps.getConnectionStatus()
         return ps
     except serial.SerialException as e:
@@ -0,0 +1,160 @@
+import numpy as np
+import logging
+
+from library_power_supply import clampRampRate, fieldToCurrents
+import CONSTANTS as c
+
+"""
+This library plans the order and the timing of the field steps of a sweep before it starts.
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class FieldSchedule:
+    """
+    Field steps of a sweep with the currents they need and the time the supplies take to ramp to them.
+    ramp_rate is clamped to the range the supplies accept (see clampRampRate), as setRampRate does.
+    The first step (the reference field prepended by GUI_measurement.py) always stays first, the others are reordered according to order:
+        "as_given"    keeps the order of the field sweep
+        "ascending"   sorts by increasing field
+        "descending"  sorts by decreasing field
+        "nearest"     always goes to the closest remaining current, this gives the shortest total ramp but ignores hysteresis
+    """
+
+    def __init__(self, field_sweep: list[float], angle: float, dipole: int, ramp_rate: float = c.RAMP_RATE, order: str = c.FIELD_ORDER) -> None:
+        self.angle = angle
+        self.dipole = dipole
+        self.ramp_rate = clampRampRate(ramp_rate)
+        self.order = order
+
+        fields = np.asarray(field_sweep, dtype=float)
+        currents = np.array([fieldToCurrents(field, angle, dipole) for field in fields]).reshape(-1, 3)
+        self.indices = self._order(currents, fields, order)
+        self.fields = fields[self.indices]
+        self.angles = np.full(len(fields), float(angle))
+        self.currents = currents[self.indices]
+        self.grid_steps = np.argsort(self.indices).reshape(1, -1)
+
+        self.ramp_times = self._ramp_times(self.currents, self.ramp_rate)
+
+    @staticmethod
+    def _ramp_times(currents: np.ndarray, ramp_rate: float) -> np.ndarray:
+        # the supplies start from 0 A and ramp together, so every step takes as long as its largest current change
+        steps = np.diff(np.vstack([np.zeros((1, 3)), currents]), axis=0)
+        return np.max(np.abs(steps), axis=1) / ramp_rate
+
+    @staticmethod
+    def _order(currents: np.ndarray, fields: np.ndarray, order: str) -> np.ndarray:
+        n = len(fields)
+        if n < 3 or order == "as_given":
+            return np.arange(n)
+        if order == "ascending":
+            return np.concatenate([[0], 1 + np.argsort(fields[1:], kind="stable")])
+        if order == "descending":
+            return np.concatenate([[0], 1 + np.argsort(-fields[1:], kind="stable")])
+        if order == "nearest":
+            indices = [0]
+            remaining = list(range(1, n))
+            while remaining:
+                distances = np.max(np.abs(currents[remaining] - currents[indices[-1]]), axis=1)
+                indices.append(remaining.pop(int(np.argmin(distances))))
+            return np.array(indices)
+        raise ValueError(f"Unknown field order: {order}")
+
+    @property
+    def reference_steps(self) -> np.ndarray:
+        """
+        Step of the reference field measured at the angle of every step, the first step of its row of grid_steps.
+        """
+        reference_steps = np.zeros(self.grid_steps.size, dtype=int)
+        for row in self.grid_steps:
+            reference_steps[row] = row[0]
+        return reference_steps
+
+    def settling_times(self, settling_mode: str = c.SETTLING_MODE) -> np.ndarray:
+        """
+        Time to wait after each step: the ramp plus the fixed settling time, or the ramp plus one readback poll in adaptive mode.
+        """
+        extra = c.SETTLING_POLL_INTERVAL if settling_mode == "adaptive" else c.SETTLING_TIME
+        return self.ramp_times + extra
+
+    def trigger_holdoff(self) -> float:
+        """
+        Time the VNA waits after each trigger in a triggered sweep: the longest ramp after the first step plus the settling time.
+        """
+        return float(np.max(self.ramp_times[1:], initial=0) + c.SETTLING_TIME)
+
+    def predict_time(self, settings: dict, avg: int = 1, n_sparams: int = 4) -> float:
+        """
+        Predicts the duration of the sweep in seconds from the ramp and settling times, the VNA sweep time (points / bandwidth)
+        and the time to transfer the traces at VNA_TRANSFER_RATE.
+        """
+        n_points = int(settings["number_of_points"])
+        sweep_time = n_points / float(settings["bandwidth"]) * avg
+        bytes_per_value = 8 if c.VNA_DATA_FORMAT == "REAL,64" else 4
+        transfer_time = (2 * n_sparams + 1) * n_points * bytes_per_value / c.VNA_TRANSFER_RATE
+        settling = self.settling_times(settings.get("settling_mode", c.SETTLING_MODE))
+        if settings.get("sweep_mode", c.SWEEP_MODE) == "triggered":
+            settling = np.concatenate([settling[:1], np.full(len(settling) - 1, self.trigger_holdoff())])
+        return float(np.sum(settling) + len(self.fields) * (sweep_time + transfer_time))
+
+    def log_summary(self, settings: dict, avg: int = 1) -> None:
+        predicted = self.predict_time(settings, avg)
+        logger.info(f"Field schedule ({self.order}): {len(self.fields)} steps, total ramp {np.sum(self.ramp_times):.1f}s at {self.ramp_rate} A/s")
+        logger.info(f"Predicted run time: {predicted:.0f}s ({predicted / 60:.1f} min)")
+
+
+class AngleFieldSchedule(FieldSchedule):
+    """
+    Steps of a 2D sweep over (angle, field) for the quadrupole, with the same ramp and timing model as FieldSchedule.
+    grid_steps[a, f] is the step at which angles[a], field_sweep[f] is measured. The steps are ordered according to order:
+        "as_given"    one field sweep per angle, in the given order
+        "serpentine"  one field sweep per angle, with the direction of the fields after the reference field reversed at every
+                      other angle. As every angle starts at its reference field, this only shortens the ramps when the reference
+                      field is at the top of the sweep, with the reference at the bottom "as_given" ramps less
+        "nearest"     always goes to the closest remaining current over all the (angle, field) pairs
+    The first field (the reference field) of every angle is always measured before the other fields of that angle,
+    so the steps can be normalized to it while the sweep runs. The first step is the reference field of the first angle.
+    """
+
+    def __init__(self, angles: list[float], field_sweep: list[float], ramp_rate: float = c.RAMP_RATE, order: str = c.ANGLE_ORDER) -> None:
+        self.angle_values = np.asarray(angles, dtype=float)
+        self.field_values = np.asarray(field_sweep, dtype=float)
+        self.dipole = 2
+        self.ramp_rate = clampRampRate(ramp_rate)
+        self.order = order
+
+        n_angles, n_fields = len(self.angle_values), len(self.field_values)
+        angle_grid, field_grid = np.meshgrid(self.angle_values, self.field_values, indexing="ij")
+        currents = np.array([fieldToCurrents(field, angle, 2) for angle, field in zip(angle_grid.ravel(), field_grid.ravel())]).reshape(-1, 3)
+
+        if order == "as_given":
+            self.indices = np.arange(n_angles * n_fields)
+        elif order == "serpentine":
+            grid = np.arange(n_angles * n_fields).reshape(n_angles, n_fields)
+            grid[1::2, 1:] = grid[1::2, :0:-1]
+            self.indices = grid.ravel()
+        elif order == "nearest":
+            self.indices = self._nearest(currents, n_angles, n_fields)
+        else:
+            raise ValueError(f"Unknown angle order: {order}")
+
+        self.angles = angle_grid.ravel()[self.indices]
+        self.fields = field_grid.ravel()[self.indices]
+        self.currents = currents[self.indices]
+        self.grid_steps = np.argsort(self.indices).reshape(n_angles, n_fields)
+        self.ramp_times = self._ramp_times(self.currents, self.ramp_rate)
+
+    @staticmethod
+    def _nearest(currents: np.ndarray, n_angles: int, n_fields: int) -> np.ndarray:
+        # greedy shortest ramp over the (angle, field) pairs, a field of an angle becomes available once its reference field is measured
+        indices = [0]
+        remaining = list(range(1, n_angles * n_fields))
+        while remaining:
+            available = [k for k in remaining if k % n_fields == 0 or k - k % n_fields in indices]
+            distances = np.max(np.abs(currents[available] - currents[indices[-1]]), axis=1)
+            k = available[int(np.argmin(distances))]
+            indices.append(k)
+            remaining.remove(k)
+        return np.array(indices)
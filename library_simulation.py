@@ -0,0 +1,341 @@
+import numpy as np
+import re
+import threading
+from time import sleep, monotonic
+import logging
+
+import CONSTANTS as c
+
+"""
+This library contains simulated instruments that replace the VNA and the power supplies when no hardware is connected.
+SimulatedVNA answers the subset of the RsInstrument interface used by library_vna, SimulatedSerial the subset of serial.Serial used by PowerSupply.
+Both are deterministic: the same commands give the same data, so full sweeps can be run in tests and benchmarks.
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SimulatedMagnet:
+    """
+    Shared state between the simulated power supplies and the simulated VNA.
+    Every supply adds a field component proportional to its current, the components of different supplies are orthogonal.
+    """
+
+    def __init__(self, field_per_amp: float = c.SIM_FIELD_PER_AMP) -> None:
+        self.field_per_amp = field_per_amp
+        self.currents = {}
+        self.trigger_listeners = []
+        self.lock = threading.Lock()
+
+    def set_current(self, port: str, current: float) -> None:
+        with self.lock:
+            self.currents[port] = current
+
+    def field(self) -> float:
+        """
+        Returns the magnitude of the field in mT.
+        """
+        with self.lock:
+            return float(np.hypot.reduce([0.0] + [i * self.field_per_amp for i in self.currents.values()]))
+
+    def trigger(self) -> None:
+        """
+        Sends a pulse on the trigger line from the VNA to the supplies.
+        """
+        for listener in list(self.trigger_listeners):
+            listener()
+
+
+# Magnet shared by the instruments created by setupConnectionPS and setupConnectionVNA in simulation mode
+simulated_magnet = SimulatedMagnet()
+
+
+def fmr_sparams(freqs: np.ndarray, field: float, sparams: list[str]) -> np.ndarray:
+    """
+    Synthetic S parameters of a coplanar waveguide with a thin magnetic film on top.
+    The resonance follows the in-plane Kittel formula f = gamma * sqrt(H * (H + Ms)) and shows up as a Lorentzian dip in transmission.
+    Returns an array of shape (len(sparams), len(freqs)).
+    """
+    gamma = 0.028e9     # Hz/mT
+    Ms = 1000           # mT
+    alpha = 0.01
+    H = abs(field)
+
+    f_res = gamma * np.sqrt(H * (H + Ms))
+    linewidth = 2 * alpha * f_res + 50e6
+    chi = (linewidth / 2) / (freqs - f_res + 1j * linewidth / 2)
+    background = np.exp(-2j * np.pi * freqs * 5e-9)      # 5 ns of cable
+
+    transmission = 0.8 * background * (1 - 0.3 * 1j * chi)
+    reflection = 0.1 * background * (1 + 0.15 * 1j * chi)
+
+    return np.array([transmission if sparam[1] != sparam[2] else reflection for sparam in sparams])
+
+
+class SimulatedVNA:
+    """
+    Stands in for RsInstrument.
+    Keeps the stimulus, the traces and the transfer format set through SCPI commands and answers the data queries with fmr_sparams
+    at the field of the magnet. Commands cost command_latency seconds, sweeps n_points / bandwidth seconds and data transfers
+    len(data) / transfer_rate seconds.
+    """
+
+    driver_version = "simulated"
+    full_instrument_model_name = "Simulated VNA"
+    instrument_options = []
+
+    def __init__(self, magnet: SimulatedMagnet = simulated_magnet, command_latency: float = c.SIM_VNA_COMMAND_LATENCY, transfer_rate: float = c.SIM_VNA_TRANSFER_RATE, noise: float = 1e-3, seed: int = 0) -> None:
+        self.magnet = magnet
+        self.command_latency = command_latency
+        self.transfer_rate = transfer_rate
+        self.noise = noise
+        self.seed = seed
+        self.visa_timeout = 10000
+        self.n_commands = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.settings = {
+            "SENS1:FREQ:STAR": 300e3,
+            "SENS1:FREQ:STOP": 8.5e9,
+            "SENS1:BAND": 10e3,
+            "SENS1:SWE:POIN": 201,
+            "SENS1:SWE:TYPE": "LIN",
+            "SENS1:SWE:COUN": 1,
+            "SENS1:AVER:COUN": 1,
+            "SENS1:AVER": "OFF",
+            "SOUR1:POW": 0,
+            "FORM": "ASCII",
+            "FORM:BORD": "NORM",
+            "TRIG:CHAN1:AUX1": "OFF",
+            "TRIG:CHAN1:AUX1:POS": "BEF",
+            "TRIG:HOLD": 0,
+        }
+        self.traces = {"Trc1": "S21"}
+        self.segments = []
+        self.n_sweeps = 0
+        self.data = None
+
+    def _wait(self, seconds: float) -> None:
+        if seconds > 0:
+            sleep(seconds)
+
+    def _normalize_header(self, header: str) -> str:
+        header = header.strip().lstrip(":").upper()
+        header = header.replace("SENSE", "SENS").replace("SOURCE", "SOUR").replace("FORMAT", "FORM")
+        header = header.replace("AVERAGE", "AVER").replace("COUNT", "COUN").replace("BORDER", "BORD")
+        return header
+
+    def write(self, command: str) -> None:
+        self.n_commands += 1
+        self._wait(self.command_latency)
+
+        for part in command.split(";"):
+            self._execute(part.strip())
+
+    write_str = write
+
+    def _execute(self, command: str) -> None:
+        if not command:
+            return
+        if command.upper() == "*RST":
+            self.reset()
+            return
+
+        header, _, argument = command.partition(" ")
+        header = self._normalize_header(header)
+        names = re.findall(r"'([^']*)'", argument)
+
+        if header == "CALC1:PAR:SDEF":
+            self.traces[names[0]] = names[1].upper().replace("AVG", "")
+        elif header == "CALC1:PAR:DEL":
+            self.traces.pop(names[0], None)
+        elif header.startswith("INIT") and "IMM" in header:
+            self._sweep()
+        elif header == "SENS1:SEGM:DEL:ALL":
+            self.segments = []
+        elif header.startswith("SENS1:SEGM") and header.endswith(":INS"):
+            start, stop, points = argument.split(",")[:3]
+            self.segments.append((float(start), float(stop), int(points)))
+        elif header == "FORM":
+            data_format = argument.strip().upper()
+            self.settings["FORM"] = "ASCII" if data_format.startswith("ASC") else data_format
+        elif header in self.settings:
+            value = argument.strip()
+            try:
+                value = float(value)
+            except ValueError:
+                value = value.upper()
+            self.settings[header] = value
+
+    def _sweep(self) -> None:
+        n_points = len(self.stimulus())
+        self._wait(float(self.settings["TRIG:HOLD"]))
+        self._wait(n_points / float(self.settings["SENS1:BAND"]) * int(self.settings["SENS1:SWE:COUN"]))
+
+        freqs = self.stimulus()
+        S = fmr_sparams(freqs, self.magnet.field(), list(self.traces.values()))
+        rng = np.random.default_rng((self.seed, self.n_sweeps))
+        # with averaging on, the sweeps of one INIT are averaged and the noise drops with the square root of their number
+        n_averaged = min(int(self.settings["SENS1:SWE:COUN"]), int(self.settings["SENS1:AVER:COUN"])) if self.settings["SENS1:AVER"] == "ON" else 1
+        noise = self.noise / np.sqrt(max(n_averaged, 1))
+        S = S + noise * (rng.standard_normal(S.shape) + 1j * rng.standard_normal(S.shape))
+        self.n_sweeps += 1
+        self.data = S
+
+        if self.settings["TRIG:CHAN1:AUX1"] == "ON":
+            self.magnet.trigger()
+
+    def stimulus(self) -> np.ndarray:
+        if self.settings["SENS1:SWE:TYPE"].startswith("SEGM"):
+            return np.concatenate([np.linspace(start, stop, points) for start, stop, points in self.segments])
+        return np.linspace(self.settings["SENS1:FREQ:STAR"], self.settings["SENS1:FREQ:STOP"], int(self.settings["SENS1:SWE:POIN"]))
+
+    def _float_data(self, query: str) -> np.ndarray:
+        header = self._normalize_header(query.split("?")[0])
+        if header == "CALCULATE1:DATA:STIMULUS" or header == "CALC1:DATA:STIM":
+            return self.stimulus()
+        if header.startswith("CALCULATE1:DATA:ALL") or header.startswith("CALC1:DATA:ALL"):
+            if self.data is None:
+                self._sweep()
+            S = np.asarray(self.data, dtype=np.complex128)
+            return np.stack([S.real, S.imag], axis=-1).ravel()
+        raise ValueError(f"Simulated VNA cannot answer {query}")
+
+    def query_bin_block(self, query: str) -> bytes:
+        self.n_commands += 1
+        dtype = np.dtype("<f8") if self.settings["FORM"] == "REAL,64" else np.dtype("<f4")
+        if self.settings["FORM:BORD"] != "SWAP":
+            dtype = dtype.newbyteorder(">")
+        data = self._float_data(query).astype(dtype).tobytes()
+        self._wait(self.command_latency + len(data) / self.transfer_rate)
+        return data
+
+    def query_str(self, query: str) -> str:
+        self.n_commands += 1
+        if query.strip().upper() == "*IDN?":
+            answer = "Rohde-Schwarz,Simulated VNA,000000,1.0"
+        else:
+            header = self._normalize_header(query.split("?")[0])
+            if header in self.settings:
+                answer = f"{self.settings[header]}"
+            else:
+                answer = ",".join(f"{x:.12E}" for x in self._float_data(query))
+        self._wait(self.command_latency + len(answer) / self.transfer_rate)
+        return answer
+
+    def query_with_opc(self, query: str, timeout: int = 0) -> str:
+        self.write(query.rsplit(";", 1)[0] if "*OPC?" in query.upper() else query)
+        return "1"
+
+    def close(self) -> None:
+        logger.info("Closed simulated VNA")
+
+
+class SimulatedSerial:
+    """
+    Stands in for serial.Serial on the port of a F2031 power supply.
+    Every command terminated by \\r is answered with CMLT\\r after latency seconds, CUR sets the current of the port on the magnet.
+    The readback (PS_READBACK_COMMAND) ramps linearly to the set current at the rate set with RATE.
+    A current list loaded with PS_LIST_COMMAND is stepped through by the triggers of the magnet, up to the count set with SWTRIG.
+    """
+
+    def __init__(self, port: str, baud_rate: int, magnet: SimulatedMagnet = simulated_magnet, latency: float = c.SIM_PS_LATENCY, timeout: float | None = None) -> None:
+        self.port = port
+        self.name = port
+        self.baudrate = baud_rate
+        self.magnet = magnet
+        self.latency = latency
+        self.timeout = timeout
+        self.is_open = True
+        self.current = 0.0
+        self.output = 0
+        self.rate = 1.0
+        self._ramp_from = 0.0
+        self._ramp_start = monotonic()
+        self._command = b""
+        self._answer = b""
+        self.current_list = []
+        self.triggers = 0
+        self.magnet.set_current(port, 0.0)
+        self.magnet.trigger_listeners.append(self._on_trigger)
+
+    def isOpen(self) -> bool:
+        return self.is_open
+
+    def write(self, data: bytes) -> int:
+        self._command += data
+        while b"\r" in self._command:
+            command, self._command = self._command.split(b"\r", 1)
+            self._answer += self._execute(command.decode("utf-8").strip())
+        return len(data)
+
+    def _execute(self, command: str) -> bytes:
+        if command == "*IDN?":
+            return b"Simulated F2031\r"
+
+        if command == c.PS_READBACK_COMMAND:
+            return f"{self.output_current():+.5f}\r".encode("utf-8")
+
+        header, _, argument = command.partition(" ")
+        if header == "CUR":
+            self._set_current(float(argument))
+        elif header == c.PS_LIST_COMMAND:
+            self.current_list = [float(i) for i in argument.split(",") if i]
+        elif header == "SWTRIG":
+            self.triggers = int(argument.lstrip("n"))
+        elif header == "OUT":
+            self.output = int(argument)
+        elif header == "RATE":
+            self.rate = float(argument)
+        return b"CMLT\r"
+
+    def _set_current(self, current: float) -> None:
+        self._ramp_from = self.output_current()
+        self._ramp_start = monotonic()
+        self.current = current
+        self.magnet.set_current(self.port, self.current)
+
+    def _on_trigger(self) -> None:
+        if self.is_open and self.triggers > 0 and self.current_list:
+            self.triggers -= 1
+            self._set_current(self.current_list.pop(0))
+
+    def output_current(self) -> float:
+        """
+        Returns the current that the simulated supply is outputting while it ramps to the set current.
+        """
+        ramped = self.rate * (monotonic() - self._ramp_start)
+        delta = self.current - self._ramp_from
+        if abs(delta) <= ramped:
+            return self.current
+        return self._ramp_from + np.copysign(ramped, delta)
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._answer)
+
+    def read(self, size: int = 1) -> bytes:
+        return self.read_until(None, size)
+
+    def read_until(self, expected: bytes | None = b"\r", size: int | None = None) -> bytes:
+        if self._answer:
+            sleep(self.latency)
+
+        end = len(self._answer)
+        if expected is not None and expected in self._answer:
+            end = self._answer.index(expected) + len(expected)
+        if size is not None:
+            end = min(end, size)
+
+        data, self._answer = self._answer[:end], self._answer[end:]
+        return data
+
+    def reset_input_buffer(self) -> None:
+        self._answer = b""
+
+    def close(self) -> None:
+        self.is_open = False
+        if self._on_trigger in self.magnet.trigger_listeners:
+            self.magnet.trigger_listeners.remove(self._on_trigger)
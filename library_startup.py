@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import logging
+
+from library_misc import StageTimer
+from library_power_supply import DemagTask, PowerSupply, setCurrents, setupConnectionPS
+from library_vna import RsInstrument, VNASession
+
+"""
+This library connects and configures the instruments at the start of a measurement.
+The VNA and every power supply are set up in their own thread, so the reset and the calibration loading of the VNA
+overlap with the opening of the serial ports and the ID checks of the supplies.
+"""
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _setupVNA(session: VNASession, settings: dict, timer: StageTimer) -> RsInstrument:
+    with timer.stage("vna connect"):
+        session.connect()
+    if session.needs_reset:
+        with timer.stage("vna reset"):
+            session.reset()
+    with timer.stage("vna settings"):
+        return session.configure(settings)
+
+
+def _setupPS(name: str, port: str, baud_rate: int, simulate: bool, timer: StageTimer) -> PowerSupply | None:
+    with timer.stage(f"{name} connect"):
+        ps = setupConnectionPS(port, baud_rate, simulate=simulate)
+    if ps:
+        try:
+            with timer.stage(f"{name} ID"):
+                ps.getID()
+        except TimeoutError as e:
+            # the port opened but the supply is off or not answering, as with a port that cannot be opened the supply is left out
+            logger.warning(f"Power supply on {port} is not answering. Error: {e}")
+            ps.closeConnection()
+            return None
+    return ps
+
+
+def _stopDemag(task: DemagTask, supplies: list[PowerSupply]) -> None:
+    # the task ends at 0 A when cancelled, the supplies are zeroed again in case its last step failed
+    task.cancel()
+    try:
+        task.wait()
+    except Exception as e:
+        logger.error(f"An error occurred during the demagnetizing sweep: {e}")
+    try:
+        setCurrents(supplies, [0] * len(supplies))
+    except Exception as e:
+        logger.error(f"Could not set the power supplies to 0 A: {e}")
+
+
+def setupInstruments(settings: dict, ps_ports: list[tuple[str, int]], simulate: bool = False, on_supplies_ready=None, timer: StageTimer | None = None, session: VNASession | None = None) -> tuple[PowerSupply | None, PowerSupply | None, RsInstrument]:
+    """
+    Connects the power supplies on ps_ports (a list of (port, baud rate)) and the VNA at the same time, then resets the VNA and applies settings.
+    on_supplies_ready is called with the list of supplies as soon as they are connected, while the VNA may still be loading the calibration.
+    It can return the DemagTask it started: if the setup then fails, the task is cancelled and waited for, and the supplies are set
+    to 0 A, before their ports are closed.
+    With an open session the VNA connection is reused, and the reset and the settings are skipped if they are already in place.
+    If any instrument fails, the ones connected here are closed before the error is raised.
+    Returns (ps1, ps2, instr), a supply that could not be connected is None as with setupConnectionPS.
+    """
+    timer = timer or StageTimer()
+    start = perf_counter()
+    own_session = session is None
+    session = session or VNASession(simulate)
+
+    with ThreadPoolExecutor(max_workers=len(ps_ports) + 1, thread_name_prefix="Startup") as executor:
+        vna_future = executor.submit(_setupVNA, session, settings, timer)
+        ps_futures = [executor.submit(_setupPS, f"ps{k+1}", port, baud_rate, simulate, timer) for k, (port, baud_rate) in enumerate(ps_ports)]
+
+        supplies = []
+        task = None
+        try:
+            supplies = [future.result() for future in ps_futures]
+            if on_supplies_ready:
+                task = on_supplies_ready(supplies)
+            instr = vna_future.result()
+        except Exception:
+            if isinstance(task, DemagTask):
+                _stopDemag(task, [ps for ps in supplies if ps])
+            for future in ps_futures:
+                if not future.exception() and future.result():
+                    future.result().closeConnection()
+            vna_future.exception()     # waits for the VNA thread before closing its connection
+            if own_session:
+                session.close()
+            raise
+
+    times = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timer.report().items())
+    logger.info(f"Instruments ready after {perf_counter() - start:.2f}s ({times})")
+
+    ps1, ps2 = (supplies + [None, None])[:2]
+    return ps1, ps2, instr
@@ -5,6 +5,10 @@ import numpy as np
 from time import sleep
 import json
 from RsInstrument.RsInstrument import RsInstrument
+import CONSTANTS as c
+import weakref
+import hashlib
+from library_simulation import SimulatedVNA
 
 """
 This file contains necessary functions to control and operate the VNA.
@@ -14,22 +18,90 @@ This file contains necessary functions to control and operate the VNA.
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def setupConnectionVNA(give_additional_info: bool = False) -> RsInstrument:
+class VNAState:
     """
-    Connects to the VNA.
+    Model of the settings last sent to a VNA, used to skip commands that would not change anything.
+    Settings are stored as {header: value} and traces as {trace name: measured parameter}, headers are always written in the
+    short form without a leading colon (e.g. "SENS1:AVER:COUN"), so forget can find them by prefix.
+    After a reset, or if the instrument may have been changed from the front panel, call invalidate.
+    """
+
+    def __init__(self) -> None:
+        self.values = {}
+        self.traces = {}
+
+    def write(self, instr: RsInstrument, header: str, value) -> bool:
+        """
+        Sends "{header} {value}" only if the value differs from the cached one. Returns True if the command was sent.
+        """
+        value = f"{value}"
+        if self.values.get(header) == value:
+            return False
+        instr.write(f"{header} {value}")
+        self.values[header] = value
+        return True
+
+    def set_trace(self, instr: RsInstrument, n: int, parameter: str) -> None:
+        """
+        Makes sure trace Tr{n} measures parameter and is shown in window n.
+        """
+        name = f"Tr{n}"
+        if self.traces.get(name) != parameter:
+            if name in self.traces:
+                instr.write(f"CALC1:PAR:DEL '{name}'")
+            instr.write(f"CALC1:PAR:SDEF '{name}', '{parameter}'")
+            self.traces[name] = parameter
+            self.values.pop(f"DISP:WIND{n}:TRAC{n}:FEED", None)     # the new trace has to be fed to the window again
+        self.write(instr, f"DISP:WIND{n}:STAT", "ON")
+        self.write(instr, f"DISP:WIND{n}:TRAC{n}:FEED", f"'{name}'")
+
+    def delete_traces_after(self, instr: RsInstrument, n: int) -> None:
+        """
+        Deletes the traces Tr{k} with k > n, so that CALC:DATA:ALL? returns only the first n traces.
+        """
+        for name in [name for name in self.traces if int(name[2:]) > n]:
+            instr.write(f"CALC1:PAR:DEL '{name}'")
+            del self.traces[name]
+
+    def forget(self, prefix: str) -> None:
+        """
+        Drops the cached settings whose header starts with prefix, so they are sent again the next time.
+        """
+        self.values = {header: value for header, value in self.values.items() if not header.startswith(prefix)}
+
+    def invalidate(self) -> None:
+        self.values = {}
+        self.traces = {}
+
+
+_vna_states = weakref.WeakKeyDictionary()
+
+def getVNAState(instr: RsInstrument) -> VNAState:
+    """
+    Returns the VNAState of an instrument, it is created empty the first time.
+    """
+    if instr not in _vna_states:
+        _vna_states[instr] = VNAState()
+    return _vna_states[instr]
+
+
+def setupConnectionVNA(give_additional_info: bool = False, simulate: bool = False, reset: bool = True) -> RsInstrument:
+    """
+    Connects to the VNA and resets it, unless reset=False.
     Returns object that contains methods to control the VNA.
+    With simulate=True a SimulatedVNA is returned instead.
     """
     resource_string_1 = 'TCPIP::192.168.2.101::INSTR'
     resource_string_2 = 'TCPIP::192.168.2.101::hislip0'
     resource_string_3 = 'GPIB::20::INSTR'
     resource_string_4 = 'USB::0x0AAD::0x0119::022019943::INSTR'
     resource_string_5 = 'RSNRP::0x0095::104015::INSTR'
-    instr = RsInstrument(resource_string_3, True, False)
+    instr = SimulatedVNA() if simulate else RsInstrument(resource_string_3, True, False)
 
     idn = instr.query_str('*IDN?')
-    logger.info("VNA connected correctly via GPIB")
-    instr.write('*RST')
-    instr.write("CALC1:PAR:DEL 'Trc1'")
+    logger.info("VNA connected correctly via GPIB" if not simulate else "Simulated VNA connected")
+    if reset:
+        resetVNA(instr)
 
     if give_additional_info:
         logger.info(f"\nHello, I am: '{idn}'")
@@ -40,124 +112,302 @@ def setupConnectionVNA(give_additional_info: bool = False) -> RsInstrument:
     return instr
 
 
+def resetVNA(instr: RsInstrument) -> None:
+    """
+    Resets the VNA and deletes the default trace, so that only the traces set up by acquire_traces exist.
+    """
+    instr.write('*RST')
+    instr.write("CALC1:PAR:DEL 'Trc1'")
+    getVNAState(instr).invalidate()
+
+
 def applySettings(instr: RsInstrument, settings: object) -> None:
     """
     This function takes the instrument object and a settings dict variable, then translates settings from the settings variable in queries for the VNA.
     """
     logger.info("Applying settings to VNA")
 
-    instr.write("SENS1:FREQ:STAR " + f"{settings['start_frequency']}")
-    instr.write("SENS1:FREQ:STOP " + f"{settings['stop_frequency']}")
-    instr.write("SENS1:BAND " + f"{settings['bandwidth']}")
-    instr.write("SOUR1:POW " + f"{settings['power']}")
-    instr.write("SENS1:SWE:POIN " + f"{settings['number_of_points']}")
-    instr.write_str(":MMEMORY:LOAD:CORRection 1, " + f"'{settings['cal_name']}.cal'")
+    state = getVNAState(instr)
+    if state.write(instr, ":MMEMORY:LOAD:CORRection 1,", f"'{settings['cal_name']}.cal'"):
+        # a calibration can bring its own channel settings, so the ones below are sent again after it
+        state.forget("SENS1")
+        state.forget("SOUR1")
+    state.write(instr, "SENS1:FREQ:STAR", settings['start_frequency'])
+    state.write(instr, "SENS1:FREQ:STOP", settings['stop_frequency'])
+    state.write(instr, "SENS1:BAND", settings['bandwidth'])
+    state.write(instr, "SOUR1:POW", settings['power'])
+    state.write(instr, "SENS1:SWE:TYPE", "LIN")     # an interrupted adaptive sweep can leave the VNA in segmented mode
+    state.write(instr, "SENS1:SWE:POIN", settings['number_of_points'])
     instr.visa_timeout = (settings['bandwidth']**-1 * settings['number_of_points'] * 10) * 1000 + 100
 
     logger.info("Settings applied successfully")
 
 
-def measure_amp_and_phase(instr: RsInstrument, Sparam: str, i=0, avg=1) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+# Settings that applySettings sends to the VNA
+VNA_SETTING_KEYS = ["start_frequency", "stop_frequency", "bandwidth", "power", "number_of_points", "cal_name"]
+
+
+def settingsFingerprint(settings: dict) -> str:
     """
-    Queries the VNA for values.
-    Takes as input the VNA instrument object and the S parameter that should be measured.
-    Returns frequencies, amplitude (linear), and phase.
+    Returns a hash of the settings that applySettings sends to the VNA.
     """
-    logger.info("Measuring amplitude and phase for S-parameter: %s", Sparam)
+    values = {key: settings.get(key) for key in VNA_SETTING_KEYS}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
 
-    if i > 0:
-        instr.write("CALC1:PAR:DEL 'Tr1'")
-        instr.write("CALC1:PAR:DEL 'Tr2'")
-        instr.write("CALC1:PAR:DEL 'Tr3'")
-        instr.write("CALC1:PAR:DEL 'Tr4'")
+class VNASession:
+    """
+    Keeps the connection to the VNA open across consecutive measurements.
+    The VNA is reset only the first time it is configured. After that configure skips the VNA entirely when the fingerprint of the
+    settings has not changed and no command has changed the VNAState since, otherwise applySettings only sends what differs,
+    so the calibration is reloaded only when cal_name changes.
+    Call invalidate if the VNA may have been changed from the front panel, the next configure then resets it again.
+    """
 
-    instr.write("CALC1:PAR:SDEF 'Tr1', 'S11AVG'")
-    instr.write("DISP:WIND1:STAT ON")
-    instr.write("DISP:WIND1:TRAC1:FEED 'Tr1'")
+    def __init__(self, simulate: bool = False, give_additional_info: bool = False) -> None:
+        self.simulate = simulate
+        self.give_additional_info = give_additional_info
+        self.instr = None
+        self.invalidate()
+
+    def connect(self) -> RsInstrument:
+        """
+        Returns the open connection, checking that the VNA still answers, or opens a new one.
+        """
+        if self.instr is not None:
+            try:
+                self.instr.query_str('*IDN?')
+                return self.instr
+            except Exception as e:
+                logger.warning(f"VNA session lost, reconnecting. Error: {e}")
+                self.close()
+
+        self.instr = setupConnectionVNA(self.give_additional_info, self.simulate, reset=False)
+        self.invalidate()
+        return self.instr
+
+    @property
+    def needs_reset(self) -> bool:
+        return not self.is_reset
+
+    def reset(self) -> None:
+        resetVNA(self.instr if self.instr is not None else self.connect())
+        self.is_reset = True
+        self.fingerprint = None
+
+    def configure(self, settings: dict) -> RsInstrument:
+        """
+        Brings the VNA to settings, skipping the reset and the calibration loading when they are not needed.
+        """
+        instr = self.instr if self.instr is not None else self.connect()
+        if self.needs_reset:
+            self.reset()
+
+        fingerprint = settingsFingerprint(settings)
+        state = getVNAState(instr)
+        if fingerprint == self.fingerprint and state.values == self.values:
+            logger.info("VNA settings unchanged, keeping the current configuration and calibration")
+        else:
+            applySettings(instr, settings)
+            self.fingerprint = fingerprint
+            self.values = dict(state.values)
+        return instr
 
-    instr.write("CALC1:PAR:SDEF 'Tr2', 'S21AVG'")
-    instr.write("DISP:WIND2:STAT ON")
-    instr.write("DISP:WIND2:TRAC2:FEED 'Tr2'")
+    def invalidate(self) -> None:
+        self.is_reset = False
+        self.fingerprint = None
+        self.values = None
 
-    instr.write("CALC1:PAR:SDEF 'Tr3', 'S12AVG'")
-    instr.write("DISP:WIND3:STAT ON")
-    instr.write("DISP:WIND3:TRAC3:FEED 'Tr3'")
+    def close(self) -> None:
+        if self.instr is not None:
+            try:
+                self.instr.close()
+            finally:
+                self.instr = None
+                self.invalidate()
 
-    instr.write("CALC1:PAR:SDEF 'Tr4', 'S22AVG'")
-    instr.write("DISP:WIND4:STAT ON")
-    instr.write("DISP:WIND4:TRAC4:FEED 'Tr4'")
 
-    instr.write(":INITiate1:CONTinuous:ALL OFF")
-    instr.write(":SENSE1:AVER:COUN 5; :AVER ON")
+# numpy dtypes of the binary block formats, the VNA is always asked for little-endian (swapped) byte order
+TRANSFER_FORMATS = {
+    "REAL,32": np.dtype("<f4"),
+    "REAL,64": np.dtype("<f8"),
+}
 
-    for _ in range(avg):
-        instr.query_with_opc(":INITiate1:IMMediate:ALL; *OPC?", 1000000)
 
-    tracedata = instr.query_str('CALCulate1:DATA:ALL? SDAT')
-    chan_list = instr.query_str('CONF:CHAN:CATalog?')
-    logger.info("Channel list: %s", chan_list)
+def setTransferFormat(instr: RsInstrument, data_format: str = c.VNA_DATA_FORMAT) -> None:
+    """
+    Selects the format used by the VNA to send trace data.
+    data_format is either one of the binary formats in TRANSFER_FORMATS or "ASCII".
+    """
+    state = getVNAState(instr)
+    if data_format == "ASCII":
+        state.write(instr, "FORM", "ASCii,0")
+    elif data_format in TRANSFER_FORMATS:
+        state.write(instr, "FORM", data_format)
+        state.write(instr, "FORM:BORD", "SWAP")
+    else:
+        raise ValueError(f"Unknown transfer format: {data_format}")
 
-    trace_list = instr.query_str('CONF:CHAN:TRAC:CATalog?')
-    logger.info("Trace list: %s", trace_list)
 
-    tracelist = list(map(str, tracedata.split(',')))
-    tracelist = np.array(tracelist, dtype='float32')
+def setTriggerOutput(instr: RsInstrument, enabled: bool, holdoff: float = 0) -> None:
+    """
+    Makes the VNA send a pulse on the AUX trigger output 1 at the end of every sweep, which steps the power supplies of a triggered sweep.
+    Every sweep then starts holdoff seconds after it is triggered, so the field can ramp and settle first.
+    """
+    state = getVNAState(instr)
+    state.write(instr, "TRIG:CHAN1:AUX1", "ON" if enabled else "OFF")
+    if enabled:
+        state.write(instr, "TRIG:CHAN1:AUX1:POS", "AFT")
+    state.write(instr, "TRIG:HOLD", holdoff if enabled else 0)
 
-    re1, im1, S1, amp1, phase1 = [], [], [], [], []
-    re2, im2, S2, amp2, phase2 = [], [], [], [], []
-    re3, im3, S3, amp3, phase3 = [], [], [], [], []
-    re4, im4, S4, amp4, phase4 = [], [], [], [], []
 
-    for i in range(int(len(tracelist) / 4)):
-        if (i % 2) == 0:
-            re1.append(tracelist[i])
-        else:
-            im1.append(tracelist[i])
+def setLinearSweep(instr: RsInstrument, n_points: int) -> None:
+    """
+    Sweeps n_points equally spaced between the start and stop frequency.
+    """
+    state = getVNAState(instr)
+    state.write(instr, "SENS1:SWE:TYPE", "LIN")
+    state.write(instr, "SENS1:SWE:POIN", n_points)
 
-    for i in range(len(re1)):
-        S1.append(re1[i] + 1j * im1[i])
-        amp1.append(np.abs(S1[i]))
-        phase1.append(np.angle(S1[i]))
 
-    for i in range(int(len(tracelist) / 4), int(len(tracelist) / 2), 1):
-        if (i % 2) == 0:
-            re2.append(tracelist[i])
-        else:
-            im2.append(tracelist[i])
+def setSegments(instr: RsInstrument, segments: list[tuple[float, float, int]], power: float, bandwidth: float) -> None:
+    """
+    Switches to a segmented sweep, segments is a list of (start frequency, stop frequency, number of points).
+    The segments are only sent again when they differ from the last ones.
+    """
+    state = getVNAState(instr)
+    key = f"{[(float(start), float(stop), int(points)) for start, stop, points in segments]}"
+    if state.values.get("SENS1:SEGM") != key:
+        instr.write("SENS1:SEGM:DEL:ALL")
+        for n, (start, stop, points) in enumerate(segments, start=1):
+            # start, stop, points, power, segment time (0 = automatic), unused, IF bandwidth
+            instr.write(f"SENS1:SEGM{n}:INS {start}, {stop}, {int(points)}, {power}, 0, 0, {bandwidth}")
+        state.values["SENS1:SEGM"] = key
+    state.write(instr, "SENS1:SWE:TYPE", "SEGM")
+
+
+def query_float_array(instr: RsInstrument, query: str, data_format: str = c.VNA_DATA_FORMAT) -> np.ndarray:
+    """
+    Sends a query that returns a list of numbers and converts the answer to a numpy array.
+    Binary formats are read as a definite length block and copied straight into the array, ASCII answers are split on the commas.
+    The VNA has to be set to the same format beforehand with setTransferFormat.
+    """
+    if data_format == "ASCII":
+        data = instr.query_str(query)
+        return np.array(data.split(','), dtype='float32')
 
-    for i in range(len(re2)):
-        S2.append(re2[i] + 1j * im2[i])
-        amp2.append(np.abs(S2[i]))
-        phase2.append(np.angle(S2[i]))
+    block = instr.query_bin_block(query)
+    return np.frombuffer(block, dtype=TRANSFER_FORMATS[data_format])
 
-    for i in range(int(len(tracelist) / 2), int(3 * len(tracelist) / 4), 1):
-        if (i % 2) == 0:
-            re3.append(tracelist[i])
-        else:
-            im3.append(tracelist[i])
 
-    for i in range(len(re3)):
-        S3.append(re3[i]+1j*im3[i]) 
-        amp3.append(np.abs(S3[i]))
-        phase3.append(np.angle(S3[i])) 
+# S parameters measured on every sweep, trace Tr1 holds the first one, Tr2 the second and so on
+SPARAMETERS = ["S11", "S21", "S12", "S22"]
 
 
-    for i in range(3*int(len(tracelist)/4),int(len(tracelist)),1):
-        if (i%2)==0:
-            re4.append(tracelist[i])
-        else:
-            im4.append(tracelist[i])
+def decode_sparams(tracelist: np.ndarray, n_points: int) -> np.ndarray:
+    """
+    Converts the flat answer of CALC:DATA:ALL? SDAT into complex S parameters.
+    The VNA sends the traces one after the other, each one as re, im pairs, so the buffer is viewed as complex and reshaped without copying.
+    Returns an array of shape (n_sparams, n_points).
+    """
+    if tracelist.dtype == np.float64:
+        S = np.ascontiguousarray(tracelist).view(np.complex128)
+    else:
+        S = np.ascontiguousarray(tracelist, dtype=np.float32).view(np.complex64)
+
+    if S.size % n_points != 0:
+        raise ValueError(f"Trace data of length {tracelist.size} does not match {n_points} points per trace")
+
+    return S.reshape(-1, n_points)
+
 
-    for i in range(len(re4)):
-        S4.append(re4[i]+1j*im4[i]) 
-        amp4.append(np.abs(S4[i]))
-        phase4.append(np.angle(S4[i])) 
+def acquire_traces(instr: RsInstrument, avg=1, data_format: str = c.VNA_DATA_FORMAT, sparams: list[str] | None = None, variance_target: float | None = c.AVG_VARIANCE_TARGET) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sets up one trace for each S parameter, triggers the sweep and reads the data back.
+    Only the trace, display and averaging commands that change the VNAState are sent, so after the first call this is just the sweep and the transfer.
+    The VNA averages avg sweeps by itself and is waited for once. With a variance_target the sweeps are read one by one instead,
+    see acquire_traces_until_stable.
+    sparams defaults to SPARAMETERS.
+    Returns the frequencies and the raw trace buffer, that can be converted to S parameters with decode_sparams.
+    """
+    sparams = SPARAMETERS if sparams is None else sparams
+    state = getVNAState(instr)
+    for n, sparam in enumerate(sparams, start=1):
+        state.set_trace(instr, n, f"{sparam}AVG")
+    state.delete_traces_after(instr, len(sparams))
+
+    state.write(instr, "INIT1:CONT:ALL", "OFF")
+
+    if variance_target is not None and avg > 1:
+        tracelist = acquire_traces_until_stable(instr, avg, variance_target, data_format)
+    else:
+        # one INIT runs avg sweeps that the VNA averages, so there is a single completion wait per field step
+        state.write(instr, "SENS1:SWE:COUN", avg)
+        state.write(instr, "SENS1:AVER:COUN", avg)
+        state.write(instr, "SENS1:AVER", "ON" if avg > 1 else "OFF")
+
+        with stage_timer.stage("trigger"):
+            if avg > 1:
+                instr.write("SENS1:AVER:CLE")
+            instr.query_with_opc(":INITiate1:IMMediate:ALL; *OPC?", 1000000)
+
+        with stage_timer.stage("transfer"):
+            setTransferFormat(instr, data_format)
+            tracelist = query_float_array(instr, 'CALCulate1:DATA:ALL? SDAT', data_format)
+
+    with stage_timer.stage("transfer"):
+        freq = query_float_array(instr, 'CALCulate1:DATA:STIMulus?', data_format)  # Get frequency list for complete trace
 
+    return freq, tracelist
 
 
-    freqdata = instr.query_str('CALCulate1:DATA:STIMulus?')  # Get frequency list for complete trace
-    freqlist = list(map(str, freqdata.split(',')))  # Convert the received string into a list
-    freq = np.array(freqlist, dtype='float32')
+def acquire_traces_until_stable(instr: RsInstrument, avg: int, variance_target: float, data_format: str = c.VNA_DATA_FORMAT) -> np.ndarray:
+    """
+    Reads up to avg single sweeps and averages them on the host, stopping as soon as the variance of the running average,
+    relative to the mean power of the traces, is below variance_target.
+    Returns the averaged raw trace buffer in the same format as acquire_traces.
+    """
+    state = getVNAState(instr)
+    state.write(instr, "SENS1:SWE:COUN", 1)
+    state.write(instr, "SENS1:AVER", "OFF")
+
+    mean = None
+    for n in range(1, avg + 1):
+        with stage_timer.stage("trigger"):
+            instr.query_with_opc(":INITiate1:IMMediate:ALL; *OPC?", 1000000)
+        with stage_timer.stage("transfer"):
+            setTransferFormat(instr, data_format)
+            tracelist = query_float_array(instr, 'CALCulate1:DATA:ALL? SDAT', data_format).astype(np.float64)
+
+        # Welford's running mean and sum of squared deviations
+        if mean is None:
+            mean, m2 = tracelist, np.zeros_like(tracelist)
+            continue
+        delta = tracelist - mean
+        mean = mean + delta / n
+        m2 += delta * (tracelist - mean)
+
+        relative_variance = np.mean(m2) / (n - 1) / n / max(np.mean(mean ** 2), np.finfo(float).tiny)
+        if relative_variance < variance_target:
+            logger.info(f"Average stable after {n}/{avg} sweeps (relative variance {relative_variance:.2e})")
+            break
+
+    return mean.astype(TRANSFER_FORMATS.get(data_format, np.dtype("<f4")))
+
+
+def measure_amp_and_phase(instr: RsInstrument, Sparam: str, avg=1, data_format: str = c.VNA_DATA_FORMAT, sparams: list[str] | None = None, variance_target: float | None = c.AVG_VARIANCE_TARGET) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Queries the VNA for values.
+    Takes as input the VNA instrument object and the S parameters that should be measured, one trace is set up for each of them.
+    Returns frequencies, amplitude (linear), phase and the complex S parameters.
+    Amplitude, phase and S have shape (len(sparams), n_points), rows follow the order of sparams.
+    """
+    logger.info("Measuring amplitude and phase for S-parameter: %s", Sparam)
+
+    freq, tracelist = acquire_traces(instr, avg, data_format, sparams, variance_target)
 
+    S = decode_sparams(tracelist, len(freq))
+    amp = np.abs(S)
+    phase = np.angle(S)
 
-    return freq, amp1, phase1, amp2, phase2, amp3, phase3, amp4, phase4, S1, S2, S3, S4
\ No newline at end of file
+    return freq, amp, phase, S
\ No newline at end of file
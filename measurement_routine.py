@@ -3,150 +3,239 @@ from library_power_supply import *
 from library_misc import *
 from library_vna import *
 from library_file_management import *
+from library_scheduler import FieldSchedule, AngleFieldSchedule
+from library_adaptive import AdaptiveFrequencyPlan, ResonanceTracker
 import CONSTANTS as c
+import queue
+import threading
 
 # Ensure logging is configured to capture detailed information
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class AcquisitionPipeline:
+    """
+    Decodes and saves the field steps in a background thread, so the main thread can move the field to the next step
+    as soon as the traces of the previous one have been read from the VNA.
+    The queue between the two is bounded: if decoding and saving fall behind, submit blocks instead of buffering traces without limit.
+    An error in the background thread is raised again in the main thread by the next submit or by close.
+    """
+
+    def __init__(self, sweep: SweepData, writer, maxsize: int = c.PIPELINE_QUEUE_SIZE) -> None:
+        self.sweep = sweep
+        self.writer = writer
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="AcquisitionPipeline", daemon=True)
+        self.thread.start()
+
+    def submit(self, i: int, freq: np.ndarray, tracelist: np.ndarray, currents: tuple[float, float, float]) -> None:
+        self._raise_error()
+        self.queue.put((i, freq, tracelist, currents))
+
+    def close(self) -> None:
+        """
+        Waits until all submitted steps have been saved.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue    # keep draining the queue so submit never blocks forever
+
+            i, freq, tracelist, currents = item
+            try:
+                with stage_timer.stage("decode"):
+                    self.sweep.set_step(i, freq, decode_sparams(tracelist, len(freq)), currents)
+                with stage_timer.stage("persist"):
+                    self.writer.append_step(i)
+                logger.info(f"Data of step {i+1} saved.")
+            except Exception as e:
+                self.error = e
+
+    def _raise_error(self) -> None:
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
 def measurement_routine(settings, ps1: PowerSupply, ps2: PowerSupply, instr: RsInstrument, field_sweep: list[float], angle: float, user_folder: str, sample_folder: str, measurement_name: str, dipole: int, Sparam: str, avg:int = 1, demag: bool = False) -> str:
     """
     Main function that is called by other files. 
     Goes through the whole routine for initializing, measuring and saving.
+    In quadrupole mode angle can be a list of angles, the sweep then covers every (angle, field) pair in one measurement.
     """
 
+    writer = None
+    pipeline = None
+    plan = None
+    triggered = False
+
     try:    # Everything is encapsulated in a try-except to always set the current to 0 in case of an exception
         logger.info("Starting measurement routine...")
 
         if dipole == 1:
+            if ps1 is None:
+                raise Exception("Dipole selected but the power supply is not properly connected.")
             ps = ps1
-            offset = 2.7001
-            conversion = 50.027
-            offset1 = 0
-            conversion1 = 0
-            offset2 = 0
-            conversion2 = 0
+            supplies, columns = [ps], [0]
 
         elif dipole == 2:
             if ps1 is None or ps2 is None:
                 raise Exception("Quadrupole selected but one of the power supplies is not properly connected.")
             psq1 = ps1
             psq2 = ps2
-            conversion = 0
-            offset = 0
-            offset1 = 1.7091
-            conversion1 = 43.884
-            offset2 = 1.4364
-            conversion2 = 42.473
+            supplies, columns = [psq1, psq2], [1, 2]
         else:
             raise Exception("Invalid dipole_mode parameter")
 
         logger.info("Dipole mode and power supplies configured.")
 
-        freqs_S11, fields_S11, amps_S11, phases_S11, S11 = np.array([]), np.array([]), np.array([]), np.array([]), np.array([], dtype='complex_')
-        freqs_S12, fields_S12, amps_S12, phases_S12, S12 = np.array([]), np.array([]), np.array([]), np.array([]), np.array([], dtype='complex_')
-        freqs_S21, fields_S21, amps_S21, phases_S21, S21 = np.array([]), np.array([]), np.array([]), np.array([]), np.array([], dtype='complex_')
-        freqs_S22, fields_S22, amps_S22, phases_S22, S22 = np.array([]), np.array([]), np.array([]), np.array([]), np.array([], dtype='complex_')
-        currents = np.array([])
-        currents1 = np.array([])
-        currents2 = np.array([])
+        settling_mode = settings.get("settling_mode", c.SETTLING_MODE)
+        ramp_rate = settings.get("ramp_rate", c.RAMP_RATE)
 
-        j = 0
+        angle_sweep = np.ndim(angle) > 0
+        if angle_sweep:
+            if dipole != 2:
+                raise Exception("A sweep over several angles needs the quadrupole.")
+            schedule = AngleFieldSchedule(angle, field_sweep, ramp_rate, settings.get("angle_order", c.ANGLE_ORDER))
+            settings["angle_sweep"] = list(schedule.angles)
+        else:
+            schedule = FieldSchedule(field_sweep, angle, dipole, ramp_rate, settings.get("field_order", c.FIELD_ORDER))
+        field_sweep = list(schedule.fields)
+        settings["field_sweep"] = field_sweep    # the data and the metadata follow the scheduled order
+        schedule.log_summary(settings, int(avg))
+
+        for supply in supplies:
+            supply.setRampRate(ramp_rate)
+
+        if demag:
+            DemagTask(supplies, demagCurrents(shape=settings.get("demag_profile", c.DEMAG_SHAPE))).wait()
+
+        # In a triggered sweep the supplies step through their current lists on the pulse the VNA sends at the end of each sweep
+        triggered = settings.get("sweep_mode", c.SWEEP_MODE) == "triggered" and len(field_sweep) > 1
+        if triggered and int(avg) != 1:
+            raise Exception("Triggered sweep mode needs avg_factor 1, every VNA sweep steps the field.")
+
+        # In the adaptive and tracking frequency modes every step has its own frequency points, points_per_step of them
+        n_points = int(settings["number_of_points"])
+        frequency_mode = settings.get("frequency_mode", c.FREQUENCY_MODE)
+        if frequency_mode == "adaptive":
+            if triggered:
+                raise Exception("The adaptive frequency mode cannot be used in triggered sweep mode, the survey sweeps would step the field.")
+            plan = AdaptiveFrequencyPlan(settings, schedule.reference_steps)
+        elif frequency_mode == "tracking":
+            plan = ResonanceTracker(settings, schedule.fields, schedule.angles, schedule.reference_steps)
+        if plan:
+            n_points = plan.points_per_step
+            settings["points_per_step"] = n_points
+
+        # Every step is also stored normalized to the reference field (step 0) as it is saved
+        settings["reference_mode"] = settings.get("reference_mode", c.REFERENCE_MODE)
+        sweep = SweepData(field_sweep, n_points, SPARAMETERS, angles=schedule.angles, grid_steps=schedule.grid_steps, varying_freqs=plan is not None, reference_mode=settings["reference_mode"])
+        writer = create_writer(sweep, settings, user_folder, sample_folder, measurement_name)
+        pipeline = AcquisitionPipeline(sweep, writer)
 
         for i, field in enumerate(field_sweep):
-            logger.info(f"Setting field to {field} mT (step {i+1}/{len(field_sweep)})...")
-
-            if dipole == 1:
-                current = (field - offset) / conversion
-                current1 = 0
-                current2 = 0
-                ps.setCurrent(current)
-
-            if dipole == 2:
-                current = 0
-                angle_rad = np.radians(angle)
-                current1 = (field * np.cos(angle_rad) - offset1) / conversion1
-                current2 = (field * np.sin(angle_rad) - offset2) / conversion2
-                psq1.setCurrent(current1)
-                psq2.setCurrent(current2)
-
-            logger.info(f"Field set to {field} mT. Waiting for {c.SETTLING_TIME}s to stabilize.")
-            sleep(c.SETTLING_TIME)
-            logger.info("Settling time over. Starting measurement...")
-
-            freq, a1, p1, a2, p2, a3, p3, a4, p4, S1, S2, S3, S4 = measure_amp_and_phase(instr, Sparam, j, int(avg))
-            j += 1
+            if angle_sweep:
+                logger.info(f"Setting field to {field} mT at {schedule.angles[i]} deg (step {i+1}/{len(field_sweep)})...")
+            else:
+                logger.info(f"Setting field to {field} mT (step {i+1}/{len(field_sweep)})...")
+            current, current1, current2 = schedule.currents[i]
+
+            if triggered and i > 0:
+                logger.info("Field stepped by the VNA trigger. Starting measurement...")
+            else:
+                with stage_timer.stage("ramp"):
+                    if dipole == 1:
+                        ps.setCurrent(current)
+
+                    if dipole == 2:
+                        setCurrents([psq1, psq2], [current1, current2])
+
+                with stage_timer.stage("settle"):
+                    if settling_mode == "adaptive":
+                        logger.info(f"Field set to {field} mT. Waiting for the currents to settle.")
+                        timeout = schedule.ramp_times[i] + c.SETTLING_TIMEOUT
+                        if dipole == 1:
+                            waited = waitForSettling([ps], [current], timeout=timeout)
+                        if dipole == 2:
+                            waited = waitForSettling([psq1, psq2], [current1, current2], timeout=timeout)
+                        logger.info(f"Currents settled after {waited:.3f}s. Starting measurement...")
+                    else:
+                        wait = schedule.ramp_times[i] + c.SETTLING_TIME
+                        logger.info(f"Field set to {field} mT. Waiting for {wait:.3f}s to ramp and stabilize.")
+                        sleep(wait)
+                        logger.info("Settling time over. Starting measurement...")
+
+            if triggered and i == 0:
+                with stage_timer.stage("ramp"):
+                    holdoff = schedule.trigger_holdoff()
+                    armTriggeredSweep(supplies, schedule.currents[1:, columns])
+                    setTriggerOutput(instr, True, holdoff)
+                logger.info(f"Supplies armed with {len(field_sweep) - 1} steps, the VNA waits {holdoff:.3f}s after each trigger.")
+
+            if plan:
+                with stage_timer.stage("plan"):
+                    plan.prepare_step(instr, i)
+
+            freq, tracelist = acquire_traces(instr, int(avg), variance_target=settings.get("avg_variance_target", c.AVG_VARIANCE_TARGET))
             logger.info("Measurement completed.")
 
-            currents = np.concatenate((currents, [current] * len(freq)))
-            currents1 = np.concatenate((currents1, [current1] * len(freq)))
-            currents2 = np.concatenate((currents2, [current2] * len(freq)))
-
-            freqs_S11 = np.concatenate((freqs_S11, freq))
-            fields_S11 = np.concatenate((fields_S11, [field] * len(freq)))
-            amps_S11 = np.concatenate((amps_S11, a1))
-            phases_S11 = np.concatenate((phases_S11, p1))
-            S11 = np.concatenate((S11, S1))
-
-            freqs_S21 = np.concatenate((freqs_S21, freq))
-            fields_S21 = np.concatenate((fields_S21, [field] * len(freq)))
-            amps_S21 = np.concatenate((amps_S21, a2))
-            phases_S21 = np.concatenate((phases_S21, p2))
-            S21 = np.concatenate((S21, S2))
-
-            freqs_S12 = np.concatenate((freqs_S12, freq))
-            fields_S12 = np.concatenate((fields_S12, [field] * len(freq)))
-            amps_S12 = np.concatenate((amps_S12, a3))
-            phases_S12 = np.concatenate((phases_S12, p3))
-            S12 = np.concatenate((S12, S3))
-
-            freqs_S22 = np.concatenate((freqs_S22, freq))
-            fields_S22 = np.concatenate((fields_S22, [field] * len(freq)))
-            amps_S22 = np.concatenate((amps_S22, a4))
-            phases_S22 = np.concatenate((phases_S22, p4))
-            S22 = np.concatenate((S22, S4))
-
-            logger.info("Saving data...")
-            save_data(currents, currents1, currents2, freqs_S11, fields_S11, amps_S11, phases_S11, S11, user_folder, sample_folder, measurement_name=f"{measurement_name}_S11")
-            logger.info(f'Saved file "{measurement_name}_S11.csv"')
-            settings["measurement_name"] = f"{measurement_name}_S11"
-            settings["s_parameter"] = 'S11'
-            save_metadata(settings)
-
-            save_data(currents, currents1, currents2, freqs_S21, fields_S21, amps_S21, phases_S21, S21, user_folder, sample_folder, measurement_name=f"{measurement_name}_S21")
-            logger.info(f'Saved file "{measurement_name}_S21.csv"')
-            settings["measurement_name"] = f"{measurement_name}_S21"
-            settings["s_parameter"] = 'S21'
-            save_metadata(settings)
-
-            save_data(currents, currents1, currents2, freqs_S12, fields_S12, amps_S12, phases_S12, S12, user_folder, sample_folder, measurement_name=f"{measurement_name}_S12")
-            logger.info(f'Saved file "{measurement_name}_S12.csv"')
-            settings["measurement_name"] = f"{measurement_name}_S12"
-            settings["s_parameter"] = 'S12'
-            save_metadata(settings)
-
-            save_data(currents, currents1, currents2, freqs_S22, fields_S22, amps_S22, phases_S22, S22, user_folder, sample_folder, measurement_name=f"{measurement_name}_S22")
-            logger.info(f'Saved file "{measurement_name}_S22.csv"')
-            settings["measurement_name"] = f"{measurement_name}_S22"
-            settings["s_parameter"] = 'S22'
-            save_metadata(settings)
-
-            logger.info("Data saved successfully.")
+            if plan:
+                plan.observe(i, freq, decode_sparams(tracelist, len(freq)))
+
+            pipeline.submit(i, freq, tracelist, (current, current1, current2))
+
+        if triggered:
+            setTriggerOutput(instr, False)
+            disarmTriggeredSweep(supplies)
 
         if dipole == 1:
             ps.setCurrent(0)
         if dipole == 2:
-            psq1.setCurrent(0)
-            psq2.setCurrent(0)
+            setCurrents([psq1, psq2], [0, 0])
+
+        pipeline.close()
+        logger.info("Data saved successfully.")
 
         logger.info("Measurement routine completed successfully.")
         return
 
     except Exception as e:
         logger.error(f"An error occurred: {e}")
+        # the currents go to 0 first, the VNA or the serial link that failed may also fail the trigger commands
         if dipole == 1:
             ps.setCurrent(0)
         if dipole == 2:
-            psq1.setCurrent(0)
-            psq2.setCurrent(0)
+            setCurrents([psq1, psq2], [0, 0])
+        if triggered:
+            try:
+                setTriggerOutput(instr, False)
+            except Exception as trigger_error:
+                logger.error(f"An error occurred while turning off the VNA trigger output: {trigger_error}")
+            try:
+                disarmTriggeredSweep(supplies)
+            except Exception as trigger_error:
+                logger.error(f"An error occurred while disarming the supply triggers: {trigger_error}")
         raise e
+
+    finally:
+        if plan:
+            try:
+                plan.restore(instr, settings)     # also after an error, the next measurement expects the uniform sweep
+            except Exception as e:
+                logger.error(f"An error occurred while restoring the frequency sweep: {e}")
+        if pipeline:
+            try:
+                pipeline.close()    # saves the steps already measured before the writer is closed
+            except Exception as e:
+                logger.error(f"An error occurred while saving data: {e}")
+        if writer:
+            writer.close()
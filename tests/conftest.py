@@ -0,0 +1,69 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CONSTANTS as c
+import library_power_supply
+from library_simulation import SimulatedMagnet, SimulatedSerial, SimulatedVNA
+from library_power_supply import PowerSupply
+from library_vna import resetVNA, applySettings
+
+"""
+Shared fixtures: every test writes its measurements to a temporary DATA_FOLDER_NAME and uses the simulated instruments.
+"""
+
+@pytest.fixture(autouse=True)
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(c, "DATA_FOLDER_NAME", str(tmp_path / "data"))
+    monkeypatch.setattr(c, "SETTLING_TIME", 0.0)
+    return tmp_path / "data"
+
+@pytest.fixture
+def instruments():
+    """
+    A simulated dipole supply and VNA sharing one magnet, with negligible latencies.
+    """
+    magnet = SimulatedMagnet()
+    ps = PowerSupply("SIM1", 9600, SimulatedSerial("SIM1", 9600, magnet, latency=0.0))
+    vna = SimulatedVNA(magnet, command_latency=0.0, transfer_rate=1e9)
+    return ps, vna
+
+class SilentSerial(SimulatedSerial):
+    """
+    A port that opens but whose supply never answers, like a supply that is switched off.
+    """
+
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+@pytest.fixture
+def silent_port(monkeypatch):
+    """
+    Makes the simulated supply on the port passed to the returned function silent.
+    """
+    def silence(port: str) -> None:
+        ports.add(port)
+
+    ports = set()
+    monkeypatch.setattr(library_power_supply, "SimulatedSerial", lambda port, baud_rate: (SilentSerial if port in ports else SimulatedSerial)(port, baud_rate))
+    return silence
+
+def make_settings(**overrides) -> dict:
+    """
+    Settings of a short simulated dipole sweep in the format of last_settings.json, field_sweep starts with the reference field.
+    """
+    settings = dict(
+        user_name="user", sample_name="sample", measurement_name="test", description="", dipole_mode=1, s_parameter="S21",
+        field_sweep=[0.0] + list(np.linspace(20, 100, 5)), angle=0, start_frequency=1e9, stop_frequency=10e9,
+        number_of_points=801, bandwidth=1e6, power=0, ref_field=0, cal_name="", avg_factor=1,
+    )
+    settings.update(overrides)
+    return settings
+
+def configure(vna, settings: dict) -> None:
+    resetVNA(vna)
+    applySettings(vna, settings)
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pytest
+
+import library_adaptive
+import measurement_routine
+from library_adaptive import AdaptiveFrequencyPlan, ResonanceTracker, find_resonances, plan_segments
+from library_file_management import load_measurement
+from library_vna import setSegments
+from conftest import configure, make_settings
+
+
+def check_segments(segments, start, stop, n_points):
+    assert sum(points for _, _, points in segments) == n_points
+    assert all(points > 0 for _, _, points in segments)
+    edges = [frequency for segment in segments for frequency in segment[:2]]
+    assert edges[0] >= start and edges[-1] <= stop
+    assert np.all(np.diff(edges) >= 0)
+
+@pytest.mark.parametrize("n_points", [2, 3, 5, 8, 50, 401])
+def test_plan_segments_uses_exactly_n_points(n_points):
+    rng = np.random.default_rng(n_points)
+    for n_regions in range(0, 8):
+        edges = np.sort(rng.uniform(1e9, 10e9, 2 * n_regions))
+        regions = list(zip(edges[::2], edges[1::2]))
+        check_segments(plan_segments(1e9, 10e9, regions, n_points, 1e6), 1e9, 10e9, n_points)
+
+def test_plan_segments_keeps_the_widest_regions_when_points_are_short():
+    segments = plan_segments(1e9, 10e9, [(2e9, 2.1e9), (4e9, 5e9), (7e9, 7.01e9)], 4, 1e6)
+    check_segments(segments, 1e9, 10e9, 4)
+    assert (4e9, 5e9) in [segment[:2] for segment in segments]
+
+def test_plan_segments_rejects_a_single_point():
+    with pytest.raises(ValueError):
+        plan_segments(1e9, 10e9, [(2e9, 3e9)], 1, 1e6)
+
+def test_find_resonances_marks_the_line():
+    freqs = np.linspace(1e9, 10e9, 901)
+    reference = np.ones((1, len(freqs)), dtype=complex)
+    S = reference - 0.3 * 1j * (25e6 / (freqs - 6e9 + 1j * 25e6))
+    regions = find_resonances(freqs, S, reference)
+    assert len(regions) == 1
+    assert regions[0][0] < 6e9 < regions[0][1]
+
+def test_adaptive_plan_compares_every_angle_with_its_own_reference(instruments, monkeypatch):
+    _, vna = instruments
+    settings = make_settings(frequency_mode="adaptive")
+    configure(vna, settings)
+    plan = AdaptiveFrequencyPlan(settings, reference_steps=np.array([0, 0, 2, 2]))
+    freqs = np.linspace(settings["start_frequency"], settings["stop_frequency"], plan.points_per_step)
+    plan.observe(0, freqs, np.ones((4, len(freqs)), dtype=complex))
+    plan.observe(2, freqs, np.full((4, len(freqs)), 2, dtype=complex))
+
+    references = []
+    monkeypatch.setattr(library_adaptive, "find_resonances", lambda freq, S, reference: references.append(reference) or [])
+    for i in range(4):
+        plan.prepare_step(vna, i)
+    assert len(references) == 2
+    np.testing.assert_allclose(references[0], 1)
+    np.testing.assert_allclose(references[1], 2)
+
+def test_tracker_compares_every_angle_with_its_own_reference():
+    settings = make_settings(frequency_mode="tracking")
+    tracker = ResonanceTracker(settings, [0, 50, 100, 0, 50, 100], [0, 0, 0, 90, 90, 90], reference_steps=np.array([0, 0, 0, 3, 3, 3]))
+    freqs = np.linspace(settings["start_frequency"], settings["stop_frequency"], 901)
+    rng = np.random.default_rng(0)
+    flat = np.ones((4, len(freqs)), dtype=complex) + 1e-3 * rng.standard_normal((4, len(freqs)))
+    tracker.observe(0, freqs, flat)
+    tracker.observe(3, freqs, 2 * flat)
+    tracker.full_span[4] = True
+    tracker.observe(4, freqs, 2 * flat * (1 - 0.3 * 1j * (25e6 / (freqs - 6e9 + 1j * 25e6))))
+    assert sorted(tracker.references) == [0, 3]
+    assert abs(tracker.positions[4] - 6e9) < 20e6
+
+def test_apply_settings_goes_back_to_a_linear_sweep(instruments):
+    _, vna = instruments
+    settings = make_settings()
+    configure(vna, settings)
+    setSegments(vna, [(1e9, 2e9, 10), (3e9, 4e9, 20)], 0, 1e6)
+    assert vna.settings["SENS1:SWE:TYPE"] == "SEGM"
+    configure(vna, settings)
+    assert vna.settings["SENS1:SWE:TYPE"] == "LIN"
+    assert len(vna.stimulus()) == settings["number_of_points"]
+
+def test_failed_adaptive_measurement_restores_the_linear_sweep(instruments, monkeypatch):
+    ps, vna = instruments
+    settings = make_settings(frequency_mode="adaptive")
+    configure(vna, settings)
+    acquire_traces = measurement_routine.acquire_traces
+    calls = []
+
+    def failing_acquire(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 3:
+            raise RuntimeError("VNA timeout")
+        return acquire_traces(*args, **kwargs)
+
+    monkeypatch.setattr(measurement_routine, "acquire_traces", failing_acquire)
+    with pytest.raises(RuntimeError, match="VNA timeout"):
+        measurement_routine.measurement_routine(settings, ps, None, vna, settings["field_sweep"], 0, "user", "sample", "test", 1, "S21")
+    assert vna.settings["SENS1:SWE:TYPE"] == "LIN"
+    assert len(vna.stimulus()) == settings["number_of_points"]
+
+def resonances(path: str) -> np.ndarray:
+    freqs, _, amps, _ = load_measurement(path)
+    freqs = np.broadcast_to(freqs, amps.shape)
+    return freqs[np.arange(len(amps)), np.nanargmin(amps, axis=1)]
+
+@pytest.mark.parametrize("storage_format", ["hdf5", "csv"])
+def test_tracking_follows_the_resonance(instruments, data_folder, storage_format):
+    ps, vna = instruments
+    field_sweep = [0.0] + list(np.linspace(20, 120, 11))
+    paths = {}
+    for mode in ["uniform", "tracking"]:
+        settings = make_settings(measurement_name=mode, frequency_mode=mode, field_sweep=field_sweep, number_of_points=901, storage_format=storage_format, tracking_check_every=5)
+        configure(vna, settings)
+        measurement_routine.measurement_routine(settings, ps, None, vna, field_sweep, 0, "user", "sample", mode, 1, "S21")
+        paths[mode] = os.path.join(data_folder, "user", "sample", mode if storage_format == "hdf5" else f"{mode}_S21")
+
+    freqs, _, amps, _ = load_measurement(paths["tracking"])
+    measured = np.sum(~np.isnan(freqs), axis=1)
+    assert list(measured[[0, 1, 2, 5, 10]]) == [901] * 5         # reference, no prediction yet and the checks cover the full span
+    assert list(measured[[3, 4, 6, 7, 8, 9]]) == [101] * 6       # 1 GHz window at the 10 MHz resolution of the full grid
+    np.testing.assert_allclose(resonances(paths["tracking"])[1:], resonances(paths["uniform"])[1:], atol=10e6)
@@ -0,0 +1,61 @@
+import json
+import os
+
+import pytest
+
+from batch_measurement import load_jobs, run_batch, validate_settings
+from library_file_management import writer_output_paths
+from library_vna import SPARAMETERS
+from conftest import make_settings
+
+
+def write_jobs(tmp_path, *jobs: dict) -> list[str]:
+    files = []
+    for k, settings in enumerate(jobs):
+        files.append(str(tmp_path / f"job{k}.json"))
+        with open(files[-1], "w") as f:
+            json.dump(settings, f)
+    return files
+
+def test_valid_settings_have_no_problems():
+    assert validate_settings(make_settings()) == []
+
+def test_missing_cal_name_is_reported():
+    settings = make_settings()
+    del settings["cal_name"]
+    assert validate_settings(settings) == ["missing settings: cal_name"]
+
+@pytest.mark.parametrize("key, value", [("dipole_mode", 3), ("start_frequency", 20e9), ("frequency_mode", "dense"), ("field_sweep", [0, 500]), ("ramp_rate", 0), ("ramp_rate", 5)])
+def test_invalid_settings_are_reported(key, value):
+    assert validate_settings(make_settings(**{key: value}))
+
+def test_existing_csv_folder_is_detected():
+    settings = make_settings(storage_format="csv")
+    os.makedirs(writer_output_paths(settings, SPARAMETERS)[1])
+    assert any("already exists" in problem for problem in validate_settings(settings))
+
+def test_collision_between_csv_and_hdf5_jobs_is_detected(tmp_path):
+    files = write_jobs(tmp_path, make_settings(storage_format="csv"), make_settings(storage_format="hdf5", measurement_name="test_S21"))
+    with pytest.raises(ValueError, match="used by more than one job"):
+        load_jobs(files)
+
+def test_batch_writes_status_to_the_written_folders(tmp_path):
+    jobs = load_jobs(write_jobs(
+        tmp_path,
+        make_settings(measurement_name="a", storage_format="csv", number_of_points=51, field_sweep=[0, 50]),
+        make_settings(measurement_name="b", storage_format="hdf5", number_of_points=51, field_sweep=[0, 50]),
+    ))
+    status = run_batch(jobs, str(tmp_path / "status.json"), simulate=True)
+
+    assert [job["status"] for job in status] == ["done", "done"]
+    assert len(status[0]["measurement_paths"]) == len(SPARAMETERS)
+    for job in status:
+        for path in job["measurement_paths"]:
+            with open(os.path.join(path, "status.json")) as f:
+                assert json.load(f)["status"] == "done"
+
+def test_batch_runs_dipole_jobs_without_the_second_supply(tmp_path, silent_port):
+    silent_port("COM4")
+    jobs = load_jobs(write_jobs(tmp_path, make_settings(number_of_points=51, field_sweep=[0, 50])))
+    status = run_batch(jobs, str(tmp_path / "status.json"), simulate=True)
+    assert [job["status"] for job in status] == ["done"]
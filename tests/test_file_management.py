@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+import CONSTANTS as c
+from library_file_management import SweepData, IncrementalWriter, create_writer, load_measurement
+from conftest import make_settings
+
+
+def write_sweep(storage_format: str, n_steps: int = 3, n_points: int = 11) -> tuple[SweepData, str]:
+    settings = make_settings(field_sweep=list(np.arange(n_steps, dtype=float)), number_of_points=n_points, storage_format=storage_format)
+    sweep = SweepData(settings["field_sweep"], n_points, ["S11", "S21"])
+    writer = create_writer(sweep, settings, "user", "sample", "test")
+    freqs = np.linspace(1e9, 2e9, n_points)
+    for i in range(n_steps):
+        S = np.vstack([np.full(n_points, 0.1 * (i + 1)), np.exp(1j * freqs / 1e9) * (i + 1)])
+        sweep.set_step(i, freqs, S, (i, 0, 0))
+        writer.append_step(i)
+    writer.close()
+    path = os.path.join(c.DATA_FOLDER_NAME, "user", "sample", "test" if storage_format == "hdf5" else "test_S21")
+    return sweep, path
+
+@pytest.mark.parametrize("storage_format", ["csv", "hdf5"])
+def test_written_steps_load_back(storage_format):
+    sweep, path = write_sweep(storage_format)
+    freqs, fields, amps, phases = load_measurement(path, sparam="S21")
+    np.testing.assert_allclose(freqs, sweep.freqs)
+    np.testing.assert_allclose(fields, sweep.fields)
+    np.testing.assert_allclose(amps * np.exp(1j * phases), sweep.sparam("S21"), rtol=1e-6)
+
+def test_csv_rows_are_appended_per_step():
+    _, path = write_sweep("csv", n_steps=4, n_points=5)
+    with open(os.path.join(path, "test_S21.csv")) as f:
+        assert len(f.readlines()) == 1 + 4 * 5
+
+@pytest.mark.parametrize("storage_format", ["csv", "hdf5"])
+def test_field_slice_selects_steps(storage_format):
+    sweep, path = write_sweep(storage_format, n_steps=5)
+    _, fields, amps, _ = load_measurement(path, sparam="S21", field_slice=slice(1, 5, 2))
+    np.testing.assert_allclose(fields, sweep.fields[1:5:2])
+    assert amps.shape == (2, 11)
+
+@pytest.mark.parametrize("storage_format", ["csv", "hdf5"])
+def test_empty_selection_raises_value_error(storage_format):
+    _, path = write_sweep(storage_format)
+    with pytest.raises(ValueError, match="No measured field steps"):
+        load_measurement(path, sparam="S21", field_slice=slice(10, 20))
+
+@pytest.mark.parametrize("reference_mode, expected", [("divide", [1, 2, 3, 1, 0.5]), ("subtract", [0, 1, 2, 0, -2])])
+def test_steps_are_normalized_to_the_reference_of_their_angle(reference_mode, expected):
+    # two angles, the reference field is the first field of each row of grid_steps
+    grid_steps = np.array([[0, 1, 2], [3, 4, 5]])
+    sweep = SweepData([0, 10, 20, 0, 10, 20], 3, ["S21"], angles=[0, 0, 0, 90, 90, 90], grid_steps=grid_steps, reference_mode=reference_mode)
+    freqs = np.linspace(1e9, 2e9, 3)
+    for i, value in enumerate([1, 2, 3, 4, 2]):
+        sweep.set_step(i, freqs, np.full((1, 3), value), (0, 0, 0))
+    np.testing.assert_allclose(sweep.normalized("S21")[:, 0], expected)
+
+def test_normalization_interpolates_the_reference_onto_other_points():
+    sweep = SweepData([0, 10], 3, ["S21"], varying_freqs=True, reference_mode="divide")
+    sweep.set_step(0, np.array([1e9, 2e9, 3e9]), np.array([[1, 2, 3]]), (0, 0, 0))
+    sweep.set_step(1, np.array([1.5e9, 2.5e9]), np.array([[3, 5]]), (0, 0, 0))
+    np.testing.assert_allclose(sweep.normalized("S21")[1, :2], [2, 2])
+    assert np.all(np.isnan(sweep.normalized("S21")[1, 2]))
+
+def test_csv_is_the_default_storage_format():
+    settings = make_settings()
+    assert "storage_format" not in settings
+    writer = create_writer(SweepData(settings["field_sweep"], 11, ["S21"]), settings, "user", "sample", "test")
+    assert isinstance(writer, IncrementalWriter)
+    writer.close()
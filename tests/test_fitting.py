@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+import CONSTANTS as c
+import measurement_routine
+from library_fitting import fit_measurement, fit_sweep, fit_traces
+from library_power_supply import fieldToCurrents
+from conftest import configure, make_settings
+
+
+def kittel(field: float) -> float:
+    """
+    Resonance frequency of the simulated film at the field the simulated magnet really gives for a nominal field in mT.
+    """
+    H = abs(fieldToCurrents(field, 0, 1)[0] * c.SIM_FIELD_PER_AMP)
+    return 0.028e9 * np.sqrt(H * (H + 1000))
+
+def lines(freqs, f_res, linewidth, rng, noise=0.002):
+    w = linewidth[:, None] / 2
+    S = 1 - 0.3 * w / (f_res[:, None] - freqs - 1j * w) / 1j
+    return S + noise * (rng.standard_normal(S.shape) + 1j * rng.standard_normal(S.shape))
+
+@pytest.fixture
+def simulated_sweep(instruments, data_folder):
+    ps, vna = instruments
+    field_sweep = [0.0, 20.0, 50.0, 80.0, 110.0]
+    settings = make_settings(field_sweep=field_sweep, start_frequency=1e9, stop_frequency=12e9, number_of_points=1101)
+    configure(vna, settings)
+    measurement_routine.measurement_routine(settings, ps, None, vna, field_sweep, 0, "user", "sample", "test", 1, "S21")
+    return os.path.join(data_folder, "user", "sample", "test_S21")
+
+def test_fitted_centres_follow_the_simulated_sweep(simulated_sweep):
+    fields, result = fit_measurement(simulated_sweep)
+    assert list(fields) == [20.0, 50.0, 80.0, 110.0]      # the reference field step has no line
+    assert np.all(result.converged)
+    np.testing.assert_allclose(result.f_res, [kittel(field) for field in fields], atol=20e6)
+
+def test_lorentzian_fit_of_the_raw_amplitudes(simulated_sweep):
+    fields, result = fit_measurement(simulated_sweep, model="lorentzian", normalized=False, field_slice=slice(1, None))
+    assert np.all(result.converged)
+    np.testing.assert_allclose(result.f_res, [kittel(field) for field in fields], atol=20e6)
+
+def test_errors_match_the_scatter_of_the_fits():
+    rng = np.random.default_rng(0)
+    freqs = np.linspace(1e9, 10e9, 901)
+    f_res, linewidth = rng.uniform(3e9, 8e9, 200), rng.uniform(50e6, 200e6, 200)
+    result = fit_traces(freqs, lines(freqs, f_res, linewidth, rng))
+    assert np.all(result.converged)
+    assert np.median(np.abs(result.f_res - f_res) / result.f_res_err) < 1.5
+    assert np.median(np.abs(result.linewidth - linewidth) / result.linewidth_err) < 1.5
+
+def test_fits_without_a_line_in_the_span_do_not_converge():
+    rng = np.random.default_rng(1)
+    freqs = np.linspace(1e9, 10e9, 901)
+    S = lines(freqs, np.array([5e9, 14e9, 30e9]), np.array([100e6, 100e6, 100e6]), rng)
+    S[2] = 1 + 0.002 * rng.standard_normal(len(freqs))
+    result = fit_traces(freqs, S, f_guess=[5e9, 9.9e9, 5e9])
+    assert list(result.converged) == [True, False, False]
+    assert np.all((result.f_res >= 1e9) & (result.f_res <= 10e9))
+    assert np.all((result.linewidth > 0) & (result.linewidth <= 9e9))
+
+def test_process_pool_gives_the_same_fits():
+    rng = np.random.default_rng(2)
+    freqs = np.linspace(1e9, 10e9, 401)
+    S = lines(freqs, rng.uniform(3e9, 8e9, 40), rng.uniform(50e6, 200e6, 40), rng)
+    serial = fit_sweep(freqs, S, chunk_size=10)
+    pooled = fit_sweep(freqs, S, chunk_size=10, workers=2)
+    np.testing.assert_allclose(pooled.f_res, serial.f_res)
+    np.testing.assert_array_equal(pooled.converged, serial.converged)
+
+@pytest.mark.parametrize("model", ["complex", "lorentzian"])
+def test_traces_without_valid_points_give_nan(model):
+    rng = np.random.default_rng(3)
+    freqs = np.linspace(1e9, 10e9, 401)
+    S = lines(freqs, np.array([4e9, 4e9, 6e9]), np.array([100e6, 100e6, 100e6]), rng)
+    S[1] = np.nan
+    result = fit_sweep(freqs, S if model == "complex" else np.abs(S), model)
+    assert list(result.converged) == [True, False, True]
+    assert np.isnan(result.f_res[1]) and np.isnan(result.linewidth[1]) and np.isnan(result.offset[1])
+    np.testing.assert_allclose(result.f_res[[0, 2]], [4e9, 6e9], atol=10e6)
+    assert np.all(np.isnan(fit_sweep(freqs, np.full((2, len(freqs)), np.nan), model).f_res))
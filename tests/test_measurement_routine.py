@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+
+import measurement_routine
+from library_file_management import load_measurement
+from library_simulation import SimulatedVNA
+from conftest import configure, make_settings
+
+
+class FailingVNA(SimulatedVNA):
+    """
+    A simulated VNA that stops answering from its fail_at-th sweep on, every later command raises.
+    """
+
+    def __init__(self, magnet, fail_at: int, **kwargs) -> None:
+        self.fail_at = fail_at
+        self.failed = False
+        super().__init__(magnet, **kwargs)
+
+    def _execute(self, command: str) -> None:
+        if self.failed:
+            raise TimeoutError("VNA not answering")
+        super()._execute(command)
+
+    def _sweep(self) -> None:
+        if self.n_sweeps + 1 >= self.fail_at:
+            self.failed = True
+            raise TimeoutError("VNA not answering")
+        super()._sweep()
+
+def test_triggered_sweep_steps_the_field(instruments, data_folder):
+    ps, vna = instruments
+    settings = make_settings(sweep_mode="triggered")
+    configure(vna, settings)
+    measurement_routine.measurement_routine(settings, ps, None, vna, settings["field_sweep"], 0, "user", "sample", "test", 1, "S21")
+
+    _, fields, amps, _ = load_measurement(os.path.join(data_folder, "user", "sample", "test_S21"))
+    assert list(fields) == settings["field_sweep"]
+    assert vna.n_sweeps == len(fields)
+    assert vna.settings["TRIG:CHAN1:AUX1"] == "OFF"
+    assert ps.ser.triggers == 0 and ps.ser.current == 0
+    assert len(np.unique(np.nanargmin(amps[1:], axis=1))) == len(fields) - 1     # every step is measured at its own field
+
+def test_failed_triggered_sweep_zeroes_the_current(instruments):
+    ps, vna = instruments
+    vna = FailingVNA(vna.magnet, fail_at=3, command_latency=0.0, transfer_rate=1e9)
+    settings = make_settings(sweep_mode="triggered")
+    configure(vna, settings)
+    with pytest.raises(TimeoutError):
+        measurement_routine.measurement_routine(settings, ps, None, vna, settings["field_sweep"], 0, "user", "sample", "test", 1, "S21")
+    assert ps.ser.current == 0
+    assert ps.ser.triggers == 0
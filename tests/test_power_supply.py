@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from library_power_supply import DemagTask, PowerSupply, demagCurrents
+from library_simulation import SimulatedSerial
+from conftest import SilentSerial
+
+
+def test_default_demag_profile_is_the_original_sweep():
+    np.testing.assert_allclose(demagCurrents(), [3, -1.5, 0.75, -0.375, 0.1875, -0.09375, 0.045, -0.02, 0.01, -0.005, 0.002, -0.001, 0.0005])
+
+@pytest.mark.parametrize("shape", ["geometric", "linear"])
+def test_demag_profiles_alternate_and_decay(shape):
+    currents = demagCurrents(start=2.0, n_steps=8, shape=shape)
+    assert currents[0] == 2.0
+    assert np.all(np.sign(currents[1:]) == -np.sign(currents[:-1]))
+    assert np.all(np.diff(np.abs(currents)) < 0)
+
+def test_unknown_demag_profile():
+    with pytest.raises(ValueError):
+        demagCurrents(shape="sine")
+
+def test_demag_task_ends_at_zero(instruments):
+    ps, _ = instruments
+    task = DemagTask([ps], [1.0, -0.5, 0.25], step_time=0.0)
+    assert task.wait(timeout=5)
+    assert ps.ser.current == 0
+
+class TruncatingSerial(SimulatedSerial):
+    """
+    A port whose answers lose their final \\r, as when the timeout expires in the middle of an answer.
+    """
+
+    def read_until(self, expected: bytes | None = b"\r", size: int | None = None) -> bytes:
+        return super().read_until(expected, size).rstrip(b"\r")
+
+def test_answers_are_read_up_to_the_carriage_return(instruments):
+    ps, _ = instruments
+    assert ps.query("*IDN?\r") == "Simulated F2031\r"
+    ps.setCurrent(0.5)
+    assert ps.ser.in_waiting == 0
+
+@pytest.mark.parametrize("serial_class", [SilentSerial, TruncatingSerial])
+def test_missing_carriage_return_raises_timeout(serial_class):
+    ps = PowerSupply("SIM1", 9600, serial_class("SIM1", 9600, latency=0.0), timeout=0.1)
+    with pytest.raises(TimeoutError):
+        ps.getID()
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from library_scheduler import AngleFieldSchedule, FieldSchedule
+
+
+@pytest.mark.parametrize("order", ["as_given", "ascending", "descending", "nearest"])
+def test_field_schedule_keeps_the_reference_first(order):
+    schedule = FieldSchedule([5.0, 40.0, 10.0, 30.0, 20.0], 0, 1, order=order)
+    assert schedule.fields[0] == 5.0
+    assert sorted(schedule.fields) == [5.0, 10.0, 20.0, 30.0, 40.0]
+    np.testing.assert_array_equal(schedule.fields[schedule.grid_steps[0]], [5.0, 40.0, 10.0, 30.0, 20.0])
+
+@pytest.mark.parametrize("order", ["as_given", "serpentine", "nearest"])
+def test_angle_schedule_measures_each_reference_before_its_angle(order):
+    angles, fields = [0.0, 45.0, 90.0, 135.0], [0.0, 10.0, 20.0, 30.0]
+    schedule = AngleFieldSchedule(angles, fields, order=order)
+    grid = schedule.grid_steps
+    assert sorted(grid.ravel()) == list(range(len(angles) * len(fields)))
+    assert grid[0, 0] == 0
+    assert np.all(grid[:, :1] < grid[:, 1:])
+    np.testing.assert_array_equal(schedule.angles[grid], np.repeat(np.array(angles)[:, None], len(fields), axis=1))
+    np.testing.assert_array_equal(schedule.fields[grid], np.repeat(np.array(fields)[None], len(angles), axis=0))
+
+def test_serpentine_reverses_the_fields_of_every_other_angle():
+    schedule = AngleFieldSchedule([0.0, 90.0], [30.0, 0.0, 10.0, 20.0], order="serpentine")
+    assert list(schedule.fields) == [30.0, 0.0, 10.0, 20.0, 30.0, 20.0, 10.0, 0.0]
+
+def test_default_angle_order_ramps_least_with_the_reference_at_the_bottom():
+    angles, fields = [0.0, 30.0, 60.0, 90.0], [0.0] + list(np.linspace(20, 100, 5))
+    ramp = {order: np.sum(AngleFieldSchedule(angles, fields, order=order).ramp_times) for order in ["as_given", "serpentine"]}
+    assert np.sum(AngleFieldSchedule(angles, fields).ramp_times) == ramp["as_given"] < ramp["serpentine"]
+
+@pytest.mark.parametrize("ramp_rate, used", [(5.0, 2.0), (0.0, 0.01), (0.5, 0.5)])
+def test_schedule_uses_the_ramp_rate_of_the_supplies(ramp_rate, used):
+    schedule = FieldSchedule([0.0, 50.0], 0, 1, ramp_rate)
+    assert schedule.ramp_rate == used
+    np.testing.assert_allclose(schedule.ramp_times, np.abs(np.diff(np.concatenate([[0], schedule.currents[:, 0]]))) / used)
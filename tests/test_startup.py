@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+import library_startup
+from library_power_supply import DemagTask
+from conftest import make_settings
+
+
+def test_failed_vna_setup_stops_the_demag_before_closing_the_supplies(monkeypatch):
+    def failing_vna(session, settings, timer):
+        time.sleep(0.2)
+        raise RuntimeError("VNA not found")
+
+    monkeypatch.setattr(library_startup, "_setupVNA", failing_vna)
+    started = []
+
+    def start_demag(supplies):
+        started.append((supplies, DemagTask(supplies, [3.0, -1.5, 0.75, -0.375], step_time=0.1)))
+        return started[-1][1]
+
+    with pytest.raises(RuntimeError, match="VNA not found"):
+        library_startup.setupInstruments(make_settings(), [("SIM1", 9600), ("SIM2", 9600)], simulate=True, on_supplies_ready=start_demag)
+
+    supplies, task = started[0]
+    assert task.done()
+    assert all(ps.ser.current == 0 for ps in supplies)
+    assert not any(ps.ser.isOpen() for ps in supplies)
+
+def test_silent_supply_is_left_out(silent_port):
+    silent_port("COM4")
+    ps1, ps2, instr = library_startup.setupInstruments(make_settings(), [("COM3", 9600), ("COM4", 9600)], simulate=True)
+    assert ps1 is not None and ps2 is None
+    ps1.closeConnection()
+    instr.close()
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from library_simulation import SimulatedVNA
+from library_vna import SPARAMETERS, acquire_traces, applySettings, decode_sparams, getVNAState, query_float_array, setTransferFormat
+from conftest import configure, make_settings
+
+
+class CalibrationVNA(SimulatedVNA):
+    """
+    A simulated VNA whose calibrations bring their own stimulus, as a calibration saved with other settings does.
+    """
+
+    def _execute(self, command: str) -> None:
+        if command.upper().startswith(":MMEMORY:LOAD:CORR"):
+            self.settings.update({"SENS1:FREQ:STAR": 300e3, "SENS1:FREQ:STOP": 8.5e9, "SENS1:SWE:POIN": 201, "SENS1:AVER:COUN": 1, "SENS1:AVER": "OFF"})
+            return
+        super()._execute(command)
+
+def record_commands(vna) -> list[str]:
+    commands = []
+    write = vna.write
+
+    def recording_write(command: str) -> None:
+        commands.append(command)
+        write(command)
+
+    vna.write = recording_write
+    return commands
+
+
+def test_acquire_traces_defaults_to_all_sparams(instruments):
+    _, vna = instruments
+    configure(vna, make_settings())
+    freq, tracelist = acquire_traces(vna)
+    assert decode_sparams(tracelist, len(freq)).shape == (len(SPARAMETERS), 801)
+
+def test_acquire_traces_does_not_share_the_default(instruments):
+    _, vna = instruments
+    configure(vna, make_settings())
+    freq, tracelist = acquire_traces(vna, sparams=["S21"])
+    assert decode_sparams(tracelist, len(freq)).shape == (1, 801)
+    assert SPARAMETERS == ["S11", "S21", "S12", "S22"]
+    freq, tracelist = acquire_traces(vna)
+    assert decode_sparams(tracelist, len(freq)).shape == (4, 801)
+
+def test_steps_after_the_first_only_trigger_the_sweep(instruments):
+    _, vna = instruments
+    configure(vna, make_settings())
+    acquire_traces(vna)
+    commands = record_commands(vna)
+    acquire_traces(vna)
+    assert commands == [":INITiate1:IMMediate:ALL"]
+
+def test_stimulus_is_sent_again_after_a_new_calibration(instruments):
+    _, vna = instruments
+    vna = CalibrationVNA(vna.magnet, command_latency=0.0, transfer_rate=1e9)
+    settings = make_settings(cal_name="first")
+    configure(vna, settings)
+    acquire_traces(vna, avg=4)
+
+    settings["cal_name"] = "second"
+    applySettings(vna, settings)
+    assert len(vna.stimulus()) == settings["number_of_points"]
+    assert vna.stimulus()[0] == settings["start_frequency"]
+    assert not any(header.startswith("SENS1:AVER") or header.startswith("SENS1:SWE:COUN") for header in getVNAState(vna).values)
+
+    acquire_traces(vna, avg=4)
+    assert vna.settings["SENS1:AVER"] == "ON" and vna.settings["SENS1:AVER:COUN"] == 4
+
+def test_binary_and_ascii_transfers_give_the_same_data(instruments):
+    _, vna = instruments
+    configure(vna, make_settings())
+    acquire_traces(vna, data_format="ASCII")
+    transfers = {}
+    for data_format in ["REAL,32", "REAL,64", "ASCII"]:
+        setTransferFormat(vna, data_format)
+        freq = query_float_array(vna, "CALCulate1:DATA:STIMulus?", data_format)
+        S = decode_sparams(query_float_array(vna, "CALCulate1:DATA:ALL? SDAT", data_format), len(freq))
+        transfers[data_format] = freq, S
+
+    freq, S = transfers["REAL,64"]
+    assert S.dtype == np.complex128 and S.shape == (len(SPARAMETERS), 801)
+    for data_format in ["REAL,32", "ASCII"]:
+        assert transfers[data_format][1].dtype == np.complex64
+        np.testing.assert_allclose(transfers[data_format][0], freq, rtol=1e-7)
+        np.testing.assert_allclose(transfers[data_format][1], S, rtol=1e-6, atol=1e-7)
+
+def test_decode_sparams_rejects_a_partial_trace():
+    with pytest.raises(ValueError):
+        decode_sparams(np.zeros(2 * 801 - 2, dtype=np.float32), 801)
+
+def test_averaged_step_is_one_sweep_on_the_vna(instruments):
+    _, vna = instruments
+    configure(vna, make_settings())
+    commands = record_commands(vna)
+    acquire_traces(vna, avg=4)
+    assert [command for command in commands if "INIT" in command.upper()] == ["INIT1:CONT:ALL OFF", ":INITiate1:IMMediate:ALL"]
+    assert commands.index("SENS1:AVER:CLE") < commands.index(":INITiate1:IMMediate:ALL")
+    assert vna.settings["SENS1:AVER"] == "ON" and vna.settings["SENS1:AVER:COUN"] == 4 and vna.settings["SENS1:SWE:COUN"] == 4
+    assert vna.n_sweeps == 1